@@ -10,6 +10,8 @@
 from astropy.table import Table
 from astropy.coordinates import Angle
 
+import calendar
+import cPickle
 import ctypes
 from datetime import datetime, timedelta
 import ExposureSet
@@ -18,9 +20,12 @@ import gui
 import GXN
 import logging as log
 import numpy
+import os
+import Pephem
 import smtplib
 import SimpleQueue
-from threading import Thread
+import Telemetry
+from threading import Lock, Thread
 import time
 
 
@@ -38,10 +43,14 @@ next_target = []
 target_plan = []
 #last_focus = [datetime(2010, 1, 1, 1, 1, 1) , 14.3]
 last_focus = [datetime.now() , 14.38]
+target_offset = [0, 0] # arcsec moved by filter_move since the last slew
 stop_loop = False
 
 force_focus = True
 
+# Biases and darks taken tonight, see Telemetry.night_of
+closed_frames = {'night': None, 'bias': 0, 'dark': 0}
+
 
 # create logger
 log.basicConfig(filename="C:\\sedm\\logs\\rcrc.txt",
@@ -69,47 +78,71 @@ Constants = {
 def classname(object):
     return object.__class__.__name__
 
+# The inputs built from the last status poll, shared until the next one
+the_inputs = {'version': None}
+the_inputs_lock = Lock()
+input_fields = {} # record class name -> trait names
+
 def get_input():
+    '''Returns the state machine inputs: the status records as dicts plus
+    the derived Sun_Is_Up, Calibration_Time and Observe_Time flags. They
+    are built once per status poll and shared by every caller until the
+    next poll, so callers must not modify them.'''
+    
+    global the_inputs
+    with the_inputs_lock:
+        if the_inputs['version'] != Status.poller.version:
+            the_inputs = build_input()
+        status = dict(the_inputs)
+    
+    # A poller that has died leaves its last values behind; don't trust them
+    status['Age'] = Status.age()
+    status['Stale'] = Status.is_stale()
+    if status['Stale']:
+        log.warning("Status is stale, last complete poll %i s ago" %
+            status['Age'])
+        status['OK'] = False
+    
+    return status
 
+def build_input():
+    
     status = {}
     
     status['OK'] = False
-    for object in [Status.weather, Status.telescope, Status.status]:
-        for trait in object.traits():
-            
+    # Hold the poller lock so all three records come from the same cycle
+    with Status.lock:
+        status['version'] = Status.poller.version
+        for object in [Status.weather, Status.telescope, Status.status]:
             cn = classname(object)
-            try:
-                if cn not in status:
-                    status[cn] = {trait: object.__getattribute__(trait)}
-                else:
-                    status[cn][trait] = object.__getattribute__(trait)
-            except AttributeError:
-                pass
+            if cn not in input_fields:
+                input_fields[cn] = [trait for trait in object.traits()
+                    if trait != 'version' and hasattr(object, trait)]
+            status[cn] = dict([(trait, getattr(object, trait))
+                for trait in input_fields[cn]])
     
     if status['Status']['UTC'] == '': return status
     status['OK'] = True
     
-    y,d,h,m,s = map(float, status['Status']['UTC'].split(":"))
-    sunrise_h, sunrise_m = map(float, status['Telescope']['UTsnrs'].split(":"))
-    sunset_h, sunset_m = map(float, status['Telescope']['UTSunset'].split(":"))
-    
-    hm = h+m/60.
-    sunset_hm = sunset_h + sunset_m/60.
-    sunrise_hm = sunrise_h + sunrise_m/60.
-
-    sunup = (hm < sunset_hm) or (hm > sunrise_hm)
+    # The TCS clock, against tonight's precomputed ephemeris
+    y,d,h,m,s = status['Status']['UTC'].split(":")
+    t = calendar.timegm(time.strptime("%s:%s" % (y, d), "%Y:%j")) + \
+        float(h)*3600 + float(m)*60 + float(s)
+    night = Pephem.ephemeris(t)
+    sunset = night.crossings['sunset']
+    if t >= night.crossings['sunrise']:
+        # The calibration window before the next sunset may open before
+        # the next night does, at noon
+        sunset = Pephem.ephemeris(t + 86400).crossings['sunset']
+
+    sunup = night.is_sun_up(t)
     
     status['Status']['Sun_Is_Up']= sunup
     if sunup: log.debug("Sun is up")
     
-    # Calibration time is 2 hours before sunrise
-    calibration_h = sunset_h-Constants['hours_before_sunset_to_calibrate']
-    calibration_m = sunset_m
-    
-    if calibration_h <= 0: calibration_h += 24
-    
-    calibration_hm = calibration_h + calibration_m/60.
-    calibration_time = (hm >= calibration_hm) or (hm < sunset_hm)
+    # Calibration time is the hours before sunset
+    calibration_time = t < sunset and \
+        t >= sunset - Constants['hours_before_sunset_to_calibrate']*3600
 
 
     if calibration_time: 
@@ -119,14 +152,33 @@ def get_input():
         status['Status']['Calibration_Time'] = False
     
     
-    # Observe time
-    status['Status']['Observe_Time'] =  hm > (sunset_hm + 0.5)
+    # Observe time is between the 12 degree twilights
+    status['Status']['Observe_Time'] = night.is_dark(t, 12)
     if not status['Status']['Observe_Time']:
-        log.info("Ready to observe at %2.2f" % (sunset_hm+0.5))
+        log.info("Ready to observe at %s UT" % time.strftime("%H:%M",
+            time.gmtime(night.crossings['sunset12'])))
     
     
     return status        
 
+def wait_for(condition, timeout):
+    '''Waits until condition(inputs) holds for good inputs, or timeout s
+    pass. condition is checked again after every status poll, so the
+    wait ends within one poll cycle of the change. Returns the last
+    inputs.'''
+    
+    start = time.time()
+    deadline = start + timeout
+    while True:
+        inputs = get_input()
+        remaining = deadline - time.time()
+        if (inputs['OK'] and condition(inputs)) or remaining <= 0 or \
+            stop_loop: break
+        Status.wait(inputs['version'], remaining)
+    
+    profiler.waited(time.time() - start)
+    return inputs
+
 def is_dome_open(status):
     
     return status['Status']['Dome_Shutter_Status'] == 'OPEN'
@@ -149,8 +201,10 @@ def is_sun_ok(status):
     s2 = not status['Status']['Sun_Is_Up']
     
     if s!= s2:
-        log.info("Sunlight_Status and sunset/sunrise times do not agree. Assuming sun is up")
+        log_change("sun_agrees", False, "Sunlight_Status and "
+            "sunset/sunrise times do not agree. Assuming sun is up")
         return False
+    logged["sun_agrees"] = True
     
     return s
 
@@ -160,13 +214,25 @@ def is_telescope_tracking(status):
     
     return status['Telescope']['Status'] == 'TRACKING'
     
+# Last value of each condition logged by log_change
+logged = {}
+
+def log_change(name, value, message):
+    '''Logs message at info level when condition name changes value, and
+    at debug level otherwise. wait_for checks conditions after every
+    status poll.'''
+    
+    if logged.get(name) != value: log.info(message)
+    else: log.debug(message)
+    logged[name] = value
+
 def is_lamp_off(status):
     '''Returns true if lamp is off'''
     
     s = status['Status']['Lamp_Status'] == 'OFF'
     
-    if s: log.info("Lamps are off")
-    else: log.info("Lamps are on")
+    if s: log_change("lamp_off", s, "Lamps are off")
+    else: log_change("lamp_off", s, "Lamps are on")
     return s
     
 def is_weather_safe(status):
@@ -174,8 +240,8 @@ def is_weather_safe(status):
     
     s = status['Status']['Weather_Status'] == 'OKAY'
     
-    if s: log.info("Weather status OK")
-    else: log.info("Weather not safe")
+    if s: log_change("weather_safe", s, "Weather status OK")
+    else: log_change("weather_safe", s, "Weather not safe")
     return s
 
 
@@ -210,9 +276,10 @@ def is_telescope_powered(status):
     if  (s['Oil_Pad_Status'] == 'READY') and \
         (s['Telescope_Power_Status'] == 'READY'):
             log.debug("Telescope is powered")
+            logged["powered"] = True
             return True
     else:
-        log.info("Telescope is not powered")
+        log_change("powered", False, "Telescope is not powered")
         return False
 
 
@@ -311,7 +378,9 @@ class startup(State):
         if not inputs['Status']['Sun_Is_Up']:
             return "open_dome"
             
-        time.sleep(10)
+        wait_for(lambda i: check_basics(i) != '' or 
+            i['Status']['Calibration_Time'] or not i['Status']['Sun_Is_Up'],
+            10)
         return "startup"
         
 class telinit(State):
@@ -322,7 +391,7 @@ class telinit(State):
         State.execute(self, prev_state_name, inputs)
         
         try: 
-            cmd = GXN.Commands()
+            cmd = GXN.QueuedCommands()
             cmd.telinit()
             cmd.close()
         except: 
@@ -343,7 +412,10 @@ class telinit_failed(State):
             log.error("Telinit failed, likely because the dome is in manual mode. Emailing people.")
             log.error("Sleeping for 10 m and trying again")
         
-        time.sleep(600)
+        # Someone may put the telescope in remote and initialize it
+        inputs = wait_for(is_telescope_initialized, 600)
+        if inputs['OK'] and is_telescope_initialized(inputs):
+            return "startup"
         return "telinit"
 
 
@@ -354,21 +426,22 @@ class configure_flats(State):
     def execute(self, prev_state_name, inputs):
         State.execute(self, prev_state_name, inputs)
         
-        try: 
-            log.info("Turning on lamps..")
-            GXNCmd = GXN.Commands()
-            GXNCmd.lamps_on()
-            GXNCmd.close()
-        except: 
-            return "lampson_failed"
-        
-        try: 
-            GXNCmd = GXN.Commands()
-            GXNCmd.stow_flats()
-            GXNCmd.close()
-        except:
-            GXNCmd.close()
-            return "stow_failed"
+        # Biases and darks don't need the lamps or the telescope, so take
+        # them while the lamps warm up and the telescope stows
+        cmd = GXN.AsyncCommands()
+        log.info("Turning on lamps..")
+        for start, failure in [(cmd.lamps_on, "lampson_failed"),
+            (cmd.stow_flats, "stow_failed")]:
+            pending = start()
+            try:
+                take_closed_frames(pending.done)
+            except gui.ExposureCommsProblem:
+                return "detector_problem"
+            
+            try:
+                pending.result()
+            except:
+                return failure
         
         return "take_flats"
 
@@ -383,15 +456,14 @@ class take_flats(State):
 
         rc_camera.object = "Flat"
         rc_camera.shutter = "normal"
-        for i in range(Constants['number_lamp_exposures']):
-            try:
-                expose(Constants['lamp_flat_exposure_time_s'])
-            except gui.ExposureCommsProblem:
-                return "detector_problem"
-            time.sleep(1)
+        try:
+            expose_burst(Constants['lamp_flat_exposure_time_s'],
+                Constants['number_lamp_exposures'])
+        except gui.ExposureCommsProblem:
+            return "detector_problem"
           
         try: 
-            GXNCmd = GXN.Commands()
+            GXNCmd = GXN.QueuedCommands()
             GXNCmd.lamps_off()
             GXNCmd.close()
         except:
@@ -406,14 +478,15 @@ class detector_problem(State):
     def execute(self, prev_state_name, inputs):
         State.execute(self, prev_state_name, inputs)
         
-        cmd = GXN.Commands()
+        cmd = GXN.QueuedCommands()
         cmd.stop()
         cmd.close_dome()
         cmd.close()
         log.error("Major detector problem identified. Could be unplugged or system may require reboot")
         # email people here
         
-        time.sleep(2000)
+        # Nothing in the status tells when the detector is back
+        wait_for(lambda i: False, 2000)
         return "detector_problem"
         
 class check_take_flats(State):
@@ -432,26 +505,11 @@ class take_darks(State):
     def execute(self, prev_state_name, inputs):
         State.execute(self, prev_state_name, inputs)
         
-        rc_camera.object = "bias"
-        rc_camera.shutter = "closed"
-        for i in range(Constants['number_bias_exposures']):
-            try:
-                expose(0)
-            except gui.ExposureCommsProblem:
-                return "detector_problem"
-            time.sleep(1)
-        
-        rc_camera.object = "dark"
-
-        for i in range(Constants['number_dark_exposures']):
-            try:
-                expose(Constants['dark_exposure_time'])
-            except gui.ExposureCommsProblem:
-                return "detector_problem"
-            
-            time.sleep(1)
-        
-        rc_camera.shutter = "normal"
+        # Those not already taken during configure_flats
+        try:
+            take_closed_frames()
+        except gui.ExposureCommsProblem:
+            return "detector_problem"
 
         return "waitfor_sunset"
         
@@ -464,7 +522,7 @@ class waitfor_sunset(State):
         State.execute(self, prev_state_name, inputs)
         
         if inputs['Status']['Sun_Is_Up']:
-            time.sleep(10)
+            wait_for(lambda i: not i['Status']['Sun_Is_Up'], 10)
             return "waitfor_sunset"    
         
         return "open_dome"
@@ -488,7 +546,7 @@ class open_dome(State):
         
         if not is_dome_open(inputs):
             try: 
-                cmd = GXN.Commands()
+                cmd = GXN.QueuedCommands()
                 cmd.open_dome()
                 cmd.close()
             except:
@@ -520,7 +578,7 @@ class open_dome_failed(State):
         
         if not is_dome_open(inputs):
             try: 
-                cmd = GXN.Commands()
+                cmd = GXN.QueuedCommands()
                 cmd.open_dome()
                 cmd.close()
             except:
@@ -541,14 +599,14 @@ class weather_safe(State):
         
         if is_telescope_tracking(inputs):
             try:
-                cmd = GXN.Commands()
+                cmd = GXN.QueuedCommands()
                 cmd.stop()
                 cmd.close()
             except:
                 cmd.close()
                 
         if not is_weather_safe(inputs):
-            time.sleep(30)
+            wait_for(is_weather_safe, 30)
             return "weather_safe"
         
         return "observe"
@@ -569,7 +627,8 @@ class observe(DomeOpenState):
 
             return "select_target"
 
-        time.sleep(10)
+        wait_for(lambda i: is_ok_to_observe(i) or not is_weather_safe(i) or
+            not is_sun_ok(i), 10)
         return "observe"
 
         
@@ -585,6 +644,7 @@ class select_target(DomeOpenState):
         
 
         lst = inputs['Telescope']['LST']
+        queue_modified = SimpleQueue.modified()
         log.debug("SimpleQueue.select_next_target at %s" % lst)
         next_target = SimpleQueue.select_next_target(lst)
         
@@ -593,7 +653,9 @@ class select_target(DomeOpenState):
     
         if next_target[0] is None:
             log.debug("No target found")
-            time.sleep(20)
+            # Targets also rise with the LST, hence the timeout
+            wait_for(lambda i: SimpleQueue.modified() != queue_modified or
+                not is_weather_safe(i) or not is_sun_ok(i), 20)
             return "select_target"
         
         times = {"u": next_target['u'],
@@ -614,17 +676,25 @@ class slew_to_target(DomeOpenState):
 
         ns=DomeOpenState.execute(self, prev_state_name, inputs)
         if ns != '': return ns
-        global next_target, last_focus, force_focus
+        global next_target, last_focus, force_focus, target_offset
         
 
         try:
-            cmd = GXN.Commands()
+            cmd = GXN.QueuedCommands()
             cmd.coords( next_target['ra'], 
                         next_target['dec'],
                         next_target['epoch'],
                         0, 0, 0)
-            cmd.go()
             cmd.close()
+            
+            # Keep watching the weather while the telescope moves
+            move = GXN.AsyncCommands().go()
+            while not move.wait(2):
+                if not is_weather_safe(get_input()):
+                    move.cancel()
+                    return "weather_safe"
+            move.result()
+            target_offset = [0, 0]
         except Exception as e:
             log.error("Failed to slew: %s" % e)
             cmd.close()
@@ -632,8 +702,10 @@ class slew_to_target(DomeOpenState):
             return "slew_failed"
                 
         time_since_last_focus = datetime.now() - last_focus[0]
-        log.info("Time since last focus %i s" % time_since_last_focus.seconds)
-        if time_since_last_focus.seconds > Constants['Hours_between_focus']*60*60:
+        log.info("Time since last focus %i s" %
+            time_since_last_focus.total_seconds())
+        if time_since_last_focus.total_seconds() > \
+            Constants['Hours_between_focus']*60*60:
             return "secfocus_loop"
         
         if force_focus:
@@ -695,7 +767,7 @@ class filter_move(DomeOpenState):
         DomeOpenState.__init__(self)
         
     def execute(self, prev_state_name, inputs):
-        global next_target, target_plan
+        global next_target, target_plan, target_offset
         ns=DomeOpenState.execute(self, prev_state_name, inputs)
         if ns != '': return ns
 
@@ -706,9 +778,10 @@ class filter_move(DomeOpenState):
         log.info("Moving %i %i" % (dRA, dDec))
                 
         try:
-            cmds = GXN.Commands()
+            cmds = GXN.QueuedCommands()
             cmds.pt(dRA, dDec)
             cmds.close()
+            target_offset = [target_offset[0] + dRA, target_offset[1] + dDec]
         except:
             log.info
         
@@ -725,7 +798,7 @@ class secfocus_loop(DomeOpenState):
             
 
         try:
-            cmd = GXN.Commands()
+            cmd = GXN.QueuedCommands()
             
             positions = numpy.arange(14.0, 14.8, 0.1)
             filenames = []
@@ -741,6 +814,8 @@ class secfocus_loop(DomeOpenState):
                     return "restart_detector_software"
                 filenames.append(rc_camera.filename)
             
+            # The focus metric needs the rewritten files
+            rc_camera.wait_processed()
             log.info("FN: %s" % str(filenames))
             fpos, fposs, metrics = Focus.rc_focus_check(filenames)
             
@@ -768,7 +843,8 @@ class telescope_not_powered(State):
         if prev_state_name != 'telescope_not_powered':
             log.error("Telescope is not powered. Emailing people")
         
-        time.sleep(20)
+        inputs = wait_for(lambda i: check_basics(i) != "telescope_not_powered", 20)
+        if not inputs['OK']: return "telescope_not_powered"
         ns = check_basics(inputs)
         if ns == "":
             return "startup"
@@ -785,20 +861,226 @@ class telescope_not_in_instrument_mode(State):
         if prev_state_name != 'telescope_not_in_instrument_mode':
             log.error("Telescope is not in instrument mode. Emailing people")
         
-        time.sleep(20)
+        inputs = wait_for(lambda i: check_basics(i) != "telescope_not_in_instrument_mode", 20)
+        if not inputs['OK']: return "telescope_not_in_instrument_mode"
         ns = check_basics(inputs)
         if ns == "":
             return "startup"
         return ns
 
+class StateStatistics:
+    '''Accumulates the time spent in each state in memory and appends it
+    to the nightly state log, one line per visit to a state: when it
+    started, the state, the state that followed, the number of ticks and
+    the seconds spent. Finished visits are buffered and written when a
+    transition happens (if flush_on_transition) or every flush_interval
+    seconds, never by rewriting the file.'''
+    
+    flush_interval = 300 # s
+    flush_on_transition = True
+    
+    def __init__(self, directory="s:/logs/states"):
+        self.directory = directory
+        self.visit = None # [start, state, n_ticks, seconds] in progress
+        self.buffer = []
+        self.last_flush = time.time()
+    
+    def record(self, state_name, next_state_name, start, seconds):
+        '''Adds one tick of state_name that lasted seconds'''
+        
+        if self.visit is None:
+            self.visit = [start, state_name, 0, 0.]
+        self.visit[2] += 1
+        self.visit[3] += seconds
+        
+        transition = state_name != next_state_name
+        if transition:
+            start, name, n, elapsed = self.visit
+            self.buffer.append("%s %-32s %-32s %5i %10.3f\n" % (
+                start.strftime("%Y-%m-%dT%H:%M:%S"), name,
+                next_state_name, n, elapsed))
+            self.visit = None
+        
+        if (transition and self.flush_on_transition) or \
+            time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+    
+    def flush(self):
+        self.last_flush = time.time()
+        if len(self.buffer) == 0: return
+        
+        dt = datetime.now()
+        fn = "%s/%4.4i_%2.2i_%2.2i_visits.txt" % (self.directory, dt.year,
+            dt.month, dt.day)
+        try:
+            f = open(fn, "a")
+            if f.tell() == 0:
+                f.write("# %-17s %-32s %-32s %5s %10s\n" % ("Start", "State",
+                    "Next", "Ticks", "Seconds"))
+            f.writelines(self.buffer)
+            f.close()
+        except IOError as e:
+            log.error("Could not write state statistics: %s" % e)
+            return
+        self.buffer = []
+
+
+class StateProfiler:
+    '''Profiles where the night goes.
+
+    Every tick of the state machine is split into shutter-open time
+    (exposures with the shutter open), idle time (spent in wait_for) and
+    overhead (everything else: slews, commands, readout). Tick lengths
+    are kept as latency histograms by state, and the length of every
+    visit to a state as histograms by transition, so report() shows
+    which states and transitions eat the night. When the night changes
+    the report of the night that ended is written to directory, if set,
+    and the profile starts again.'''
+    
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.reset()
+    
+    def reset(self, t=None):
+        if t is None: t = time.time()
+        self.night = Telemetry.night_of(t)
+        self.latencies = Telemetry.Latencies()
+        self.totals = {} # state -> [open, overhead, idle] s
+        self.open = 0. # s of the tick in progress
+        self.idle = 0.
+        self.visit_start = None
+    
+    def exposed(self, seconds):
+        self.open += seconds
+    
+    def waited(self, seconds):
+        self.idle += seconds
+    
+    def tick(self, state_name, next_state_name, start, seconds):
+        '''Accounts for one tick of state_name that began at time start'''
+        
+        if Telemetry.night_of(start) != self.night:
+            if self.directory is not None:
+                try:
+                    self.write(os.path.join(self.directory,
+                        "%s.txt" % self.night))
+                except IOError as e:
+                    log.error("Could not write the efficiency report: %s" %
+                        e)
+            self.reset(start)
+        if self.visit_start is None: self.visit_start = start
+        
+        shutter = min(self.open, seconds)
+        idle = min(self.idle, seconds - shutter)
+        totals = self.totals.setdefault(state_name, [0., 0., 0.])
+        totals[0] += shutter
+        totals[1] += seconds - shutter - idle
+        totals[2] += idle
+        self.open = self.idle = 0.
+        
+        self.latencies.record(state_name, "tick", seconds, start)
+        if state_name != next_state_name:
+            self.latencies.record("%s>%s" % (state_name, next_state_name),
+                "visit", start + seconds - self.visit_start, start)
+            self.visit_start = None
+    
+    def efficiency(self):
+        '''Returns the fractions of profiled time that were shutter-open,
+        overhead and idle'''
+        
+        if len(self.totals) == 0: return 0., 0., 0.
+        total = numpy.sum(self.totals.values(), axis=0)
+        if total.sum() == 0: return 0., 0., 0.
+        return tuple(total / total.sum())
+    
+    def report(self):
+        '''Returns an astropy Table with a row per state and per transition.
+        The split into shutter-open, overhead and idle s is by state.'''
+        
+        rows = []
+        for row in self.latencies.summary():
+            totals = [numpy.nan]*3
+            if row['Kind'] == 'tick': totals = self.totals[row['Command']]
+            rows.append([row['Command'], row['Kind'], row['N'],
+                row['N']*row['Mean s'], row['Mean s'], row['P50 s'],
+                row['P90 s'], row['Max s']] + list(totals))
+        names = ("Name", "Kind", "N", "Total s", "Mean s", "P50 s", "P90 s",
+            "Max s", "Open s", "Overhead s", "Idle s")
+        dtype = ("S40", "S5", "i4") + ("f8",)*8
+        if len(rows) == 0: return Table(names=names, dtype=dtype)
+        return Table(rows=rows, names=names, dtype=dtype)
+    
+    def write(self, fn):
+        table = self.report()
+        for name in table.colnames[3:]: table[name].format = "%.1f"
+        table.write(fn, format="ascii.fixed_width_two_line")
+        
+        f = open(fn, "a")
+        f.write("\nShutter open %.1f%%, overhead %.1f%%, idle %.1f%%\n" %
+            tuple(100*numpy.array(self.efficiency())))
+        f.close()
+
+profiler = StateProfiler()
+
+
+class Checkpoint:
+    '''Keeps the progress of the night in a small local file: the state
+    to execute next, the target and its remaining plan, the offset from
+    the target, the focus history and the biases and darks taken. Each
+    save writes a new file and then replaces the old one, so a crash
+    leaves one of the two whole.'''
+    
+    def __init__(self, fn):
+        self.fn = fn
+    
+    def save(self, state_name):
+        t = time.time()
+        progress = {'t': t, 'night': Telemetry.night_of(t),
+            'state': state_name, 'next_target': next_target,
+            'target_plan': target_plan, 'target_offset': target_offset,
+            'last_focus': last_focus, 'force_focus': force_focus,
+            'closed_frames': closed_frames}
+        
+        new = self.fn + ".new"
+        try:
+            f = open(new, "wb")
+            cPickle.dump(progress, f, 2)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            if os.path.exists(self.fn): os.remove(self.fn)
+            os.rename(new, self.fn)
+        except (IOError, OSError) as e:
+            log.error("Could not write checkpoint: %s" % e)
+    
+    def load(self):
+        '''Returns the saved progress, or None'''
+        for fn in [self.fn, self.fn + ".new"]:
+            try:
+                f = open(fn, "rb")
+                progress = cPickle.load(f)
+                f.close()
+                return progress
+            except Exception:
+                continue
+        return None
+
+
 class StateMachine:
     # statetable is initialized dynamically by programatically
     # identifying sub classes of class State/
     statetable = {}
     prev_state_name = None
     next_state_name = None
+    statistics = None
+    checkpoint = None
     
-    def __init__(self):
+    # States that need the telescope on the target, which it may have
+    # left while the software was down
+    target_states = set(['exposure_handler', 'expose_target', 'filter_move',
+        'secfocus_loop'])
+    
+    def __init__(self, checkpoint=None):
         log.info("Initializing StateMachine and all states...")
         states = State.__subclasses__()
         for state in states:
@@ -812,10 +1094,49 @@ class StateMachine:
         
         self.prev_state_name = None
         self.next_state_name = "configure_flats"
+        self.statistics = StateStatistics()
+        
+        self.checkpoint = checkpoint
+        if checkpoint is not None: self.resume()
+    
+    def resume(self):
+        '''Picks up tonight's progress from the checkpoint, if any'''
+        global next_target, target_plan, target_offset, last_focus, \
+            force_focus
+        
+        progress = self.checkpoint.load()
+        if progress is None: return
+        if progress['night'] != Telemetry.night_of(time.time()):
+            log.info("Checkpoint is from %s, starting afresh" %
+                progress['night'])
+            return
+        if progress['state'] not in self.statetable:
+            log.error("Checkpoint state %s is unknown" % progress['state'])
+            return
+        
+        next_target = progress['next_target']
+        target_plan = progress['target_plan']
+        target_offset = progress['target_offset']
+        last_focus = progress['last_focus']
+        force_focus = progress['force_focus']
+        closed_frames.update(progress.get('closed_frames', {}))
+        
+        state_name = progress['state']
+        if state_name == 'secfocus_loop':
+            force_focus = True
+        if state_name in self.target_states:
+            # Point again, then offset back to where the plan was
+            if target_offset != [0, 0]:
+                target_plan.insert(0, ('filter_move', tuple(target_offset)))
+            state_name = "slew_to_target"
+        
+        self.next_state_name = state_name
+        log.info("Resuming at %s from the checkpoint of %s" % (state_name,
+            datetime.fromtimestamp(progress['t'])))
     
     def execute(self, inputs):
         
-        now = datetime.now()
+        start = time.time()
         ns = self.statetable[self.next_state_name]
         
         log.info("Executing %s" % self.next_state_name)
@@ -825,11 +1146,22 @@ class StateMachine:
         if self.prev_state_name != self.next_state_name:
             log.info("Transitioning %s->%s" % (self.prev_state_name, 
                 self.next_state_name))
+            if self.checkpoint is not None:
+                self.checkpoint.save(self.next_state_name)
         
-        elapsed = datetime.now() - now
-        ns.elapsed += elapsed
+        elapsed = time.time() - start
+        ns.elapsed += timedelta(seconds=elapsed)
         ns.n_times += 1
         
+        self.statistics.record(self.prev_state_name, self.next_state_name,
+            datetime.fromtimestamp(start), elapsed)
+        profiler.tick(self.prev_state_name, self.next_state_name, start,
+            elapsed)
+    
+    def write_summary(self):
+        '''Writes the time in every state so far tonight as a table'''
+        
+        self.statistics.flush()
         dt = datetime.now()
         fn = "%4.4i_%2.2i_%2.2i.txt" % (dt.year, dt.month, dt.day)
         names = []
@@ -838,19 +1170,57 @@ class StateMachine:
         for statename, state in self.statetable.items():
             names.append(statename)
             times.append(state.n_times)
-            elapsed.append(state.elapsed.seconds)
+            elapsed.append(state.elapsed.total_seconds())
         
         table = Table([names, times, elapsed], 
             names=("State", "# times", "# sec"))
         table.write("s:/logs/states/%s" % fn, format="ascii.fixed_width_two_line")
             
 
+def take_closed_frames(until=None):
+    '''Takes the biases and then the darks still owed tonight, with the
+    shutter closed. With until, stops before the next frame once until()
+    is true. Returns true when all have been taken.'''
+    
+    owed = [("bias", 0, Constants['number_bias_exposures']),
+        ("dark", Constants['dark_exposure_time'],
+            Constants['number_dark_exposures'])]
+    
+    night = Telemetry.night_of(time.time())
+    if closed_frames['night'] != night:
+        closed_frames.update({'night': night, 'bias': 0, 'dark': 0})
+    
+    rc_camera.shutter = "closed"
+    try:
+        for name, itime, n in owed:
+            if closed_frames[name] >= n: continue
+            rc_camera.object = name
+            closed_frames[name] += len(expose_burst(itime,
+                n - closed_frames[name], until))
+            if closed_frames[name] < n: return False
+    finally:
+        rc_camera.shutter = "normal"
+    return True
+
 def expose(itime):
     global rc_camera
     
     rc_camera.exposure = itime
     log.info("Exposing for %3.1f s" % (itime))
     rc_camera.run()
+    if rc_camera.shutter == "normal": profiler.exposed(itime)
+
+def expose_burst(itime, n, until=None):
+    '''Takes n frames of itime s back to back, see gui.Camera.burst.
+    Returns their file names.'''
+    global rc_camera
+    
+    rc_camera.exposure = itime
+    log.info("Exposing %i frames of %3.1f s" % (n, itime))
+    filenames = rc_camera.burst(n, until)
+    if rc_camera.shutter == "normal":
+        profiler.exposed(itime * len(filenames))
+    return filenames
 
         
 def start_software():
@@ -860,6 +1230,8 @@ def start_software():
     rc_camera.status_function = get_input
     rc_camera.xpa_class = 'c6ca7de8:18639'
     rc_camera.readout=2.0
+    # Move on to the next pt or slew while the last image is rewritten
+    rc_camera.pipelined = True
         
     rc_camera.make_connection()
 
@@ -869,31 +1241,50 @@ def start_software():
 def main():
     global Status, rc_camera, theSM
     
+    Status.poller.recorder = Telemetry.Recorder("s:/logs/telemetry")
+    GXN.latencies.directory = "s:/logs/latency"
+    profiler.directory = "s:/logs/efficiency"
     Status.start()
     time.sleep(1)
     
-    theSM = StateMachine()
+    theSM = StateMachine(Checkpoint("c:/sedm/fsm_checkpoint.pkl"))
     start_software()
 
 def fsm_loop():
     global Status, rc_pid, theSM, stop_loop
-    cmd = GXN.Commands()
+    cmd = GXN.QueuedCommands()
     cmd.takecontrol()
     cmd.close()
+    backoff = 2
     while stop_loop == False:
         try:
             inputs = get_input()
+            if not inputs['OK']:
+                # No or stale status: wait for the pollers rather than
+                # deciding on old values
+                Status.wait(inputs['version'], 2)
+                continue
             theSM.execute(inputs)
+            backoff = 2
         except GXN.TCSConnectionError:
-            log.info("Caught a communication error. Rebooting computer.")
-            return
-            import os
-            email(email_list, """Sed machine cannot communicate with TCS. The
-            instrument will attempt to reboot and continue. Sorry for the spam.""")
-            log.info("executing shutdown -r")
-            #os.system("shutdown -r")
+            # Commands reconnect on their next use and the watchdog
+            # restarts the status poller, so wait out the outage
+            log.error("Caught a communication error. Retrying in %i s" %
+                backoff)
+            time.sleep(backoff)
+            backoff = min(2*backoff, 300)
     
     log.info("Received and accepted a stop request")
+    rc_camera.wait_processed()
+    theSM.write_summary()
+    try:
+        GXN.latencies.write("s:/logs/latency/%s.txt" % GXN.latencies.night)
+    except IOError as e:
+        log.error("Could not write latencies: %s" % e)
+    try:
+        profiler.write("s:/logs/efficiency/%s.txt" % profiler.night)
+    except IOError as e:
+        log.error("Could not write the efficiency report: %s" % e)
 
 
 if __name__ == '__main__':
@@ -6,15 +6,20 @@ Written by Nick Konidaris [c] 2014
 Released under GPLv2
 '''
 
-from threading import Thread
+import heapq
+import socket
 import telnetlib
 from traits.api import *
+# After traits, whose Event trait would otherwise shadow threading.Event
+from threading import Thread, Condition, Event, Lock, RLock
 import time
 import logging as log
 
 import astropy
 from astropy.coordinates import Angle
 
+import Telemetry
+
 PELE = "198.202.125.194"
 PELEPORT = 49300
 
@@ -49,52 +54,193 @@ class SlowCommandFailed(Exception):
 
 
 
+class Session:
+    '''A long-lived GXN telnet connection shared by Commands objects.
+
+    Each command holds the session lock for its full request/response so
+    that threads can not interleave on the socket. A dropped or closed
+    connection is detected before use and reestablished transparently.'''
+
+    def __init__(self, host=None, port=None):
+        # Looked up at call time so PELE can be pointed at GXNSim
+        if host is None: host = PELE
+        if port is None: port = PELEPORT
+        self.host = host
+        self.port = port
+        self.T = None
+        self.lock = RLock()
+        self.depth = 0
+        self.n_slow = 0 # slow commands awaiting their result
+        self.n_connects = 0
+        self.n_commands = 0
+
+    def connect(self):
+        self.disconnect()
+        log.info("GXN session connecting to %s:%i" % (self.host, self.port))
+        try:
+            self.T = telnetlib.Telnet(self.host, self.port)
+        except Exception as e:
+            log.error("GXN TCS Connection Error: %s" % e)
+            raise TCSConnectionError(e)
+        self.n_connects += 1
+        log.info("Connection to %s made" % self.host)
+
+    def disconnect(self):
+        if self.T is None: return
+        log.info("Closing telnet")
+        try: self.T.close()
+        except: pass
+        self.T = None
+
+    def is_healthy(self):
+        '''Cheap, non-blocking check that the socket is still open. Any
+        unsolicited bytes left over from a previous command are discarded.'''
+        if self.T is None: return False
+        try:
+            stale = self.T.read_very_eager()
+        except (EOFError, socket.error):
+            log.info("GXN session connection was dropped")
+            return False
+        if stale != "":
+            log.debug("GXN session discarded '%s'" % stale.rstrip())
+        return True
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self.depth == 0:
+            # Only check on the outermost hold; a nested check would
+            # swallow the reply to the command in progress.
+            try:
+                if not self.is_healthy():
+                    self.connect()
+            except:
+                self.lock.release()
+                raise
+            self.n_commands += 1
+        self.depth += 1
+        return self.T
+
+    def __exit__(self, type, value, traceback):
+        self.depth -= 1
+        self.lock.release()
+        return False
+
+
+the_sessions = {}
+the_sessions_lock = Lock()
+
+def shared_session(name="commands"):
+    '''Returns the process-wide GXN session called name, creating it on
+    first use'''
+    with the_sessions_lock:
+        if name not in the_sessions:
+            the_sessions[name] = Session()
+    return the_sessions[name]
+
+# Set when a slow command starts, so that pollers can speed up at once
+activity = Event()
+
+def slow_command_outstanding():
+    '''Returns true while any session is waiting on a slow command'''
+    return any([session.n_slow > 0 for session in the_sessions.values()])
+
+
+# Wall clock and round trip latencies of every GXN command
+latencies = Telemetry.Latencies()
+
+def timed(fun):
+    '''Records the wall clock latency of a Commands method, from the call
+    to its return, including waiting for the session'''
+    
+    def wrapper(self, *args, **kwargs):
+        self.command = fun.__name__
+        t0 = time.time()
+        try:
+            return fun(self, *args, **kwargs)
+        finally:
+            latencies.record(fun.__name__, "wall", time.time() - t0)
+    
+    wrapper.__name__ = fun.__name__
+    wrapper.__doc__ = fun.__doc__
+    return wrapper
+
+
 class Commands:
-    '''Wrapper around the GXN/Telnet interface'''
+    '''Wrapper around the GXN/Telnet interface.
+
+    Commands objects are cheap handles onto a shared Session; constructing
+    one does not open a connection and close() leaves the session open.
+    Each command records its wall clock latency, and the round trip from
+    sending it to its reply ("rtt"), in latencies.'''
     
-    T = None
     gxn_res = {0: "Success", -1: "Unknown command", -2: "Bad parameter", 
         -3: "Aborted", -6: "Do not have control"}
+    reply_timeout = 2 # s to wait for the reply to a fast command
     
-    def __init__(self):
+    def __init__(self, session=None):
         log.info("GXN Interface initalizing")
-        try:
-            self.T = telnetlib.Telnet(PELE, PELEPORT)
-        except Exception as e:
-            log.error("GXN TCS Connection Error: %s" % e)
-            raise TCSConnectionError(e)
-            
-        log.info("Connection to %s made" % PELE)
+        if session is None: session = shared_session()
+        self.session = session
+        self.command = None
+        self.sent = None
     
     def close(self):
-        log.info("Closing telnet")
-        self.T.close()
-        
-    def __del__(self):
-        self.close()
+        log.debug("Releasing GXN handle, session stays open")
         
     def write(self, str):
-        T = self.T
         log.debug("Sending '%s'" % str.rstrip())
-        T.write(str)
+        self.sent = time.time()
+        with self.session as T:
+            try:
+                T.write(str)
+            except socket.error as e:
+                log.info("GXN write failed (%s), reconnecting" % e)
+                self.session.connect()
+                self.session.T.write(str)
         
     def read_until(self, s,timeout):
-        T = self.T
-        try:
-            r=T.read_until(s, timeout)
-        except Exception as e:
-            raise TCSReadError(e)
+        with self.session as T:
+            try:
+                r=T.read_until(s, timeout)
+            except Exception as e:
+                self.session.disconnect()
+                raise TCSReadError(e)
+        self.record_rtt()
         log.info("GXN Cmd returned: '%s'" % r.rstrip())
+        return r
+    
+    def read_reply(self):
+        '''Reads the one line reply of a fast command. Returns as soon as
+        the terminating newline arrives; reply_timeout only bounds a TCS
+        that does not answer.'''
+        with self.session:
+            r = self.read_until("\n", self.reply_timeout)
+            if not r.endswith("\n"):
+                log.warning("GXN reply not terminated after %s s" %
+                    self.reply_timeout)
+                # Or the rest would be read as the next command's reply
+                self.session.disconnect()
+        return r
     
     def slow(self, timeout):
         '''Handle a slow command block until timeout'''
         # A slow command is defined by John Henning as a blocking command.
-        T = self.T
-        try:
-            r = T.expect(["-?\d"], timeout)[2]
-        except Exception as e:
-            log.error("GXN Slow command returned garbage")
-            return
+        with self.session as T:
+            self.session.n_slow += 1
+            try:
+                activity.set()
+                i, match, r = T.expect(["-?\d"], timeout)
+                if i == -1:
+                    # Or the late result would be read as the result of
+                    # the next slow command
+                    self.session.disconnect()
+            except Exception as e:
+                log.error("GXN Slow command returned garbage")
+                self.session.disconnect()
+                return
+            finally:
+                self.session.n_slow -= 1
+        self.record_rtt()
  
         try: res = int(r)
         except:
@@ -109,72 +255,97 @@ class Commands:
             log.error("GXN Command failed: %s" % self.gxn_res[res])
             raise SlowCommandFailed("%i: %s" % (res, self.gxn_res[res]))
 
+    
+    def record_rtt(self):
+        if self.command is None or self.sent is None: return
+        latencies.record(self.command, "rtt", time.time() - self.sent)
+        self.sent = None
         
+    @timed
     def pt(self, dRA, dDec):
         '''PT (Slow) offsets the telescope by requested amount at MRATES rates.
         Telescope_Motion_Status must be TRACKING or IN_POSITION and changes to
         MOVING during move.'''
         log.info("GXN: pt %f %f" % (dRA, dDec))
                 
-        self.write("pt %f %f\n" % (dRA, dDec))
-        self.slow(60)
+        with self.session:
+            self.write("pt %f %f\n" % (dRA, dDec))
+            self.slow(60)
     
+    @timed
     def takecontrol(self):
         '''Send takecontrol command'''
         log.info("GXN takecontrol")
-        self.write("takecontrol\n")
-        self.read_until("\n", .1)
+        with self.session:
+            self.write("takecontrol\n")
+            self.read_reply()
         
         
+    @timed
     def telinit(self):
         '''Send telinit command, block for 300 s'''
         
         log.info("GXN telinit")
-        self.write("telinit\n")
-        return self.slow(300)
+        with self.session:
+            self.write("telinit\n")
+            return self.slow(300)
     
+    @timed
     def stow_flats(self):
         '''Stow to flat position, block for 300 s'''
         
         log.info("GXN stow flats")
-        self.write("stow 0.0 85.0 90\n")
-        
-        return self.slow(300)
+        with self.session:
+            self.write("stow 0.0 85.0 90\n")
+            return self.slow(300)
     
+    @timed
     def lamps_on(self):
         log.info("GXN lamp on")
-        self.write("lampon\n")
-        time.sleep(1)
-        self.slow(30)
+        with self.session:
+            self.write("lampon\n")
+            time.sleep(1)
+            self.slow(30)
  
     
+    @timed
     def stop(self):
         log.info("GXN stop")
-        self.write("stop\n")
-        self.read_until("\n", .1)
+        with self.session:
+            self.write("stop\n")
+            self.read_reply()
            
+    @timed
     def lamps_off(self):
         log.info("GXN lamp off")
-        self.write("lampoff\n")
-        self.read_until("\n", .1)
+        with self.session:
+            self.write("lampoff\n")
+            self.read_reply()
         
+    @timed
     def open_dome(self):
         log.info("GXN open dome")
-        self.write("open\n")
-        self.slow(300)
+        with self.session:
+            self.write("open\n")
+            self.slow(300)
     
+    @timed
     def close_dome(self):
         log.info("GXN close dome")
-        self.write("close\n")
-        self.slow(300)
+        with self.session:
+            self.write("close\n")
+            self.slow(300)
     
+    @timed
     def gofocus(self, pos_mm):
         log.info("GXN Set focus stage to %2.3f" % (pos_mm))
         
-        self.write("gofocus %3.6f\n" % pos_mm)
-        self.slow(30)
+        with self.session:
+            self.write("gofocus %3.6f\n" % pos_mm)
+            self.slow(30)
         
         
+    @timed
     def coords(self, ra, # in decimal hours
                     dec, # in decimal degrees
                     equinox, # 0 means apparent
@@ -192,95 +363,335 @@ class Commands:
         dDec = aDec.deg
         
         log.info("GXN coords")
-        if epoch is not None:
-            self.write("coords %f %f %f %f %f %i %f\n" %
-                (hRA, dDec, equinox, ra_rate, dec_rate, flag, epoch))
-        else:
-            self.write("coords %f %f %f %f %f %i\n" %
-                (hRA, dDec, equinox, ra_rate, dec_rate, flag))
-        
-        self.read_until("\n", .1)
+        with self.session:
+            if epoch is not None:
+                self.write("coords %f %f %f %f %f %i %f\n" %
+                    (hRA, dDec, equinox, ra_rate, dec_rate, flag, epoch))
+            else:
+                self.write("coords %f %f %f %f %f %i\n" %
+                    (hRA, dDec, equinox, ra_rate, dec_rate, flag))
+            self.read_reply()
     
     
+    @timed
     def go(self):
         log.info ('GXN.gopos')
-        self.write('gopos\n')
-        return self.slow(300)
+        with self.session:
+            self.write('gopos\n')
+            return self.slow(300)
     
+    @timed
     def stow_day(self):
         '''Daystow, block for 300 s'''
         
         log.info('GXN daystow')
-        self.write("stow 3.6666666666 50.0 40\n")
-        
-        return self.slow(300)        
+        with self.session:
+            self.write("stow 3.6666666666 50.0 40\n")
+            return self.slow(300)
     
-class CommsThread(Thread):
-    abort = False
+class PendingCommand:
+    '''Handle on a GXN command submitted to a CommandQueue.
 
-    telescope = None
-            
-    def run(self):       
-        T = self.telescope 
+    The command runs on the queue's worker thread, so the caller is free
+    to watch weather or run the camera while the telescope moves. wait()
+    polls for completion, result() returns or raises the outcome and
+    cancel() drops the command if it has not started, or aborts the move
+    by sending stop on the control session if it has.'''
+    
+    def __init__(self, name, fun, args, kwargs, priority, control,
+        lock=None):
+        self.name = name
+        self.fun = fun
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.control = control
+        # Held by the queue while it starts the command, so that a cancel
+        # can not slip in between the queue taking it and sending it
+        if lock is None: lock = RLock()
+        self.lock = lock
+        self.error = None
+        self.cancelled = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = Event()
+    
+    def execute(self):
+        if self.started is None: self.started = time.time()
+        try:
+            self.fun(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        self.finished.set()
+    
+    def done(self):
+        return self.finished.is_set()
+    
+    def wait(self, timeout=None):
+        '''Returns True once the command has completed'''
+        self.finished.wait(timeout)
+        return self.done()
+    
+    def result(self, timeout=None):
+        '''Blocks for up to timeout s and raises if the command failed'''
+        if not self.wait(timeout):
+            raise SlowCommandFailed("%s still running after %s s" %
+                (self.name, timeout))
+        if self.error is not None:
+            raise self.error
+    
+    def cancel(self):
+        '''Cancels the command. Returns False if already complete.'''
+        with self.lock:
+            if self.done(): return False
+            log.info("Cancelling %s" % self.name)
+            self.cancelled = True
+            started = self.started
+            if started is None:
+                self.error = SlowCommandFailed("%s cancelled" % self.name)
+                self.finished.set()
+        
+        if started is not None: Commands(self.control).stop()
+        return True
+
+
+class CommandQueue(Thread):
+    '''Serializes all TCS commands through one worker thread.
+
+    Commands run in order of priority, then of submission. Submitting a
+    safety command (priority SAFETY: stop, close_dome) while a telescope
+    or dome motion is executing preempts it: stop is sent at once on the
+    control session, the motion fails with -3 Aborted and the safety
+    command runs next. depth() and stats() report the backlog and how
+    long commands waited to start.'''
+    
+    SAFETY, NORMAL = 0, 1
+    priorities = {'stop': SAFETY, 'close_dome': SAFETY}
+    motions = set(['pt', 'go', 'gofocus', 'telinit', 'stow_flats',
+        'stow_day', 'open_dome'])
+    
+    def __init__(self, session=None, control=None):
+        Thread.__init__(self, name="GXN command queue")
+        self.daemon = True
+        if control is None: control = shared_session("control")
+        self.commands = Commands(session)
+        self.control = control
+        self.heap = []
+        self.n_submitted = 0
+        self.ready = Condition()
+        self.current = None
+        self.abort = False
+        
+        self.n_done = 0
+        self.total_wait = 0.
+        self.max_wait = 0.
+    
+    def submit(self, name, *args, **kwargs):
+        '''Queues the Commands method called name and returns its
+        PendingCommand. A priority keyword overrides the default priority
+        of the command; other keywords are passed to the method.'''
+        
+        fun = getattr(self.commands, name)
+        priority = kwargs.pop("priority",
+            self.priorities.get(name, self.NORMAL))
+        pending = PendingCommand(name, fun, args, kwargs, priority,
+            self.control, self.ready)
+        
+        with self.ready:
+            heapq.heappush(self.heap, (priority, self.n_submitted, pending))
+            self.n_submitted += 1
+            self.ready.notify()
+            running = self.current
+        
+        if running is not None and priority < running.priority and \
+            running.name in self.motions:
+            log.info("%s preempts %s" % (name, running.name))
+            running.cancel()
+        
+        return pending
+    
+    def run(self):
+        log.info("Starting the GXN command queue")
         while not self.abort:
-            try:
-                self.telescope.telnet.write("?POS\n")
-            except Exception as e:
-                raise TCSReadError(e)
-                
-            while True:
-
-                r= self.telescope.telnet.read_until("\n", .1)
-                if r == "":
-                    break               
-
-                try:lhs,rhs = r.rstrip().split("=")
-                except: continue
-
-
-                if lhs == 'UTC': T.UTC = rhs
-                if lhs == 'Dome_Azimuth': T.domeaz = float(rhs)
-                if lhs == 'LST': T.LST = rhs
-                if lhs == 'Julian_Date': T.JD = float(rhs)
-                if lhs == 'Apparent_Equinox': T.appeq = float(rhs)
-                if lhs == 'Telescope_HA': T.HA = rhs
-                if lhs == 'Telescope_RA': T.RA = rhs
-                if lhs == 'Telescope_Dec': T.Dec = rhs
-                if lhs == 'Telescope_RA_Rate': T.RArate = rhs
-                if lhs == 'Telescope_Dec_Rate': T.DECrate = rhs
-                if lhs == 'Telescope_RA_Offset': T.RAoff = float(rhs)
-                if lhs == 'Telescope_Dec_Offset': T.Decoff = float(rhs)
-                if lhs == 'Telescope_Azimuth': T.Az = float(rhs)
-                if lhs == 'Telescope_Elevation': T.El = float(rhs)
-                if lhs == 'Telescope_Parallactic': T.prlltc = float(rhs)
-                if lhs == 'Telescope_HA_Speed': T.HAspeed = float(rhs)
-                if lhs == 'Telescope_Dec_Speed': T.Decspeed = float(rhs)
-                if lhs == 'Telescope_HA_Refr(arcsec)': T.HArefr = float(rhs)
-                if lhs == 'Telescope_Dec_Refr(arcsec)': T.Dec_refr = float(rhs)
-                if lhs == 'Telescope_Motion_Status': T.Status = rhs
-                if lhs == 'Telescope_Airmass': T.airmass = float(rhs)
-                if lhs == 'Object_Name': T.Name = rhs.lstrip('"').rstrip('"')
-
-                if lhs == 'Telescope_Equinox': T.equinox = rhs
-                if lhs == 'Object_RA': T.obRA = rhs
-                if lhs == 'Object_Dec': T.obDEC = rhs
-                if lhs == 'Object_RA_Rate': T.obRArt = float(rhs)
-                if lhs == 'Object_DEC_Rate': T.obDECrt = float(rhs)
-                if lhs == 'Object_RA_Proper_Motion': T.obRApm = float(rhs)
-                if lhs == 'Object_Dec_Proper_Motion': T.obDECpm = float(rhs)
-                if lhs == 'Focus_Position': T.secfocus = float(rhs)
-                if lhs == 'Dome_Gap(inch)': T.domegap = float(rhs)
-                if lhs == 'Dome_Azimuth': T.domeaz = float(rhs)
-                if lhs == 'Windscreen_Elevation': T.windsc = float(rhs)
-                if lhs == 'UTSunset': T.UTSunset = rhs
-                if lhs == 'UTSunrise': T.UTsnrs = rhs 
-
-            time.sleep(2)
+            with self.ready:
+                while len(self.heap) == 0 and not self.abort:
+                    self.ready.wait(1)
+                if self.abort: break
+                priority, n, pending = heapq.heappop(self.heap)
+                if pending.cancelled: continue
+                pending.started = time.time()
+                self.current = pending
+            
+            wait = time.time() - pending.submitted
+            self.n_done += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            log.debug("GXN %s waited %2.2f s in the queue" % (pending.name,
+                wait))
+            
+            pending.execute()
+            with self.ready:
+                self.current = None
+    
+    def depth(self):
+        '''Number of commands waiting to start'''
+        return len(self.heap)
+    
+    def stats(self):
+        mean = self.total_wait / self.n_done if self.n_done else 0.
+        return {"depth": self.depth(), "n_done": self.n_done,
+            "mean_wait": mean, "max_wait": self.max_wait}
 
-class Telescope(HasTraits):
-    comms_thread = Instance(CommsThread)
+
+the_queue = None
+the_queue_lock = Lock()
+
+def command_queue():
+    '''Returns the process-wide CommandQueue, started on first use'''
+    global the_queue
+    with the_queue_lock:
+        if the_queue is None:
+            the_queue = CommandQueue()
+            the_queue.start()
+    return the_queue
+
+
+class AsyncCommands:
+    '''Non-blocking front end to the slow GXN commands.
+
+    Each call queues the command on the shared CommandQueue and returns
+    its PendingCommand instead of blocking in Commands.slow().'''
     
-    telnet = Instance(telnetlib.Telnet)
+    def __init__(self, queue=None):
+        if queue is None: queue = command_queue()
+        self.queue = queue
+    
+    def pt(self, dRA, dDec):
+        return self.queue.submit("pt", dRA, dDec)
+    
+    def go(self):
+        return self.queue.submit("go")
+    
+    def gofocus(self, pos_mm):
+        return self.queue.submit("gofocus", pos_mm)
+    
+    def open_dome(self):
+        return self.queue.submit("open_dome")
+    
+    def close_dome(self):
+        return self.queue.submit("close_dome")
+    
+    def lamps_on(self):
+        return self.queue.submit("lamps_on")
+    
+    def stow_flats(self):
+        return self.queue.submit("stow_flats")
+
+
+class QueuedCommands:
+    '''Drop-in replacement for Commands that runs each command through
+    the shared CommandQueue and blocks until it has completed'''
+    
+    def __init__(self, queue=None):
+        if queue is None: queue = command_queue()
+        self.queue = queue
+    
+    def close(self):
+        pass
+    
+    def __getattr__(self, name):
+        if name.startswith("_") or not hasattr(Commands, name):
+            raise AttributeError(name)
+        
+        def call(*args, **kwargs):
+            return self.queue.submit(name, *args, **kwargs).result()
+        return call
+
+
+def unquote(s):
+    return s.lstrip('"').rstrip('"')
+
+# ?POS key -> (Telescope trait, converter)
+POS_KEYS = {
+    'UTC': ('UTC', str),
+    'LST': ('LST', str),
+    'Julian_Date': ('JD', float),
+    'Apparent_Equinox': ('appeq', float),
+    'Telescope_HA': ('HA', str),
+    'Telescope_RA': ('RA', str),
+    'Telescope_Dec': ('Dec', str),
+    'Telescope_RA_Rate': ('RArate', str),
+    'Telescope_Dec_Rate': ('DECrate', str),
+    'Telescope_RA_Offset': ('RAoff', float),
+    'Telescope_Dec_Offset': ('Decoff', float),
+    'Telescope_Azimuth': ('Az', float),
+    'Telescope_Elevation': ('El', float),
+    'Telescope_Parallactic': ('prlltc', float),
+    'Telescope_HA_Speed': ('HAspeed', float),
+    'Telescope_Dec_Speed': ('Decspeed', float),
+    'Telescope_HA_Refr(arcsec)': ('HArefr', float),
+    'Telescope_Dec_Refr(arcsec)': ('Dec_refr', float),
+    'Telescope_Motion_Status': ('Status', str),
+    'Telescope_Airmass': ('airmass', float),
+    'Object_Name': ('Name', unquote),
+    'Telescope_Equinox': ('equinox', str),
+    'Object_RA': ('obRA', str),
+    'Object_Dec': ('obDEC', str),
+    'Object_RA_Rate': ('obRArt', float),
+    'Object_DEC_Rate': ('obDECrt', float),
+    'Object_RA_Proper_Motion': ('obRApm', float),
+    'Object_Dec_Proper_Motion': ('obDECpm', float),
+    'Focus_Position': ('secfocus', float),
+    'Dome_Gap(inch)': ('domegap', float),
+    'Dome_Azimuth': ('domeaz', float),
+    'Windscreen_Elevation': ('windsc', float),
+    'UTSunset': ('UTSunset', str),
+    'UTSunrise': ('UTsnrs', str),
+}
+
+def trait_keys(R):
+    '''Builds a key table for replies whose keys are the trait names of R,
+    converting to the type of each trait'''
+    
+    table = {}
+    for trait in R.traits():
+        if trait.startswith('trait_') or trait == 'version': continue
+        table[trait] = (trait, type(getattr(R, trait)))
+    return table
+
+
+class LineParser:
+    '''Converts key=value reply lines into attribute updates through a
+    precompiled key -> (attribute, converter) table, so the cost per line
+    is one dict lookup however many keys the TCS reports. Keys that are
+    not in the table are counted in unknown.'''
+    
+    def __init__(self, table):
+        self.table = table
+        self.unknown = {}
+        self.n_lines = 0
+        self.n_malformed = 0
+    
+    def parse(self, updates, lhs, rhs):
+        '''Stores the converted value of one line in the updates dict'''
+        self.n_lines += 1
+        try:
+            attr, convert = self.table[lhs]
+        except KeyError:
+            if lhs not in self.unknown:
+                log.info("Ignoring unknown key '%s'" % lhs)
+                self.unknown[lhs] = 0
+            self.unknown[lhs] += 1
+            return
+        
+        try:
+            updates[attr] = convert(rhs)
+        except:
+            self.n_malformed += 1
+            log.info("Ignored malformed line:'%s=%s'" % (lhs, rhs))
+
+
+class Telescope(HasTraits):
     UTC = String()
     LST = String()
     JD = Float()
@@ -315,65 +726,10 @@ class Telescope(HasTraits):
     windsc = Float()
     UTSunset = String()
     UTsnrs = String()
-    
+    version = Int() # StatusPoller cycle of the last update
     
     def __init__(self):
-        log.info("Telescope status thread initialized")
-        
-        
-        try:
-            self.telnet = telnetlib.Telnet(PELE, PELEPORT)
-        except Exception as e:
-            raise TCSConnectionError(e)
-
-        self.comms_thread = CommsThread()
-        self.comms_thread.telescope = self            
-        
-
-
-
-
-
-class GenericCommsThread(Thread):
-    abort = False
-    resultobj = None
-    
-    def run(self):
-        
-        R = self.resultobj
-        log.info("Starting a communications thread")
-        
-        while not self.abort:
-            try:
-                R.telnet.write("%s\n" % self.command)
-            except Exception as e:
-                raise TCSReadError(e)
-                
-            while True:
-
-                r= R.telnet.read_until("\n", .1)
-                
-                if r == "":
-                    break               
-
-                try:lhs,rhs = r.rstrip().split("=")
-                except: continue
-                
-                try:
-                    type_fun = type(getattr(R, lhs))
-                    setattr(R, lhs, type_fun(rhs))
-                except:
-                    log.info("Ignored malformed line:'%s'" % r.rstrip())
-                    
-                
-            time.sleep(2)
-
-                
-        
-class WeatherCommsThread(GenericCommsThread):
-    abort = False
-    command = "?WEATHER"
-
+        log.info("Telescope status initialized")
 
 
 class Weather(HasTraits):
@@ -403,21 +759,10 @@ class Weather(HasTraits):
     Secondary_Cell_Temp = Float()
     Wetness = Int()
     Weather_Status = String()
-    comms_thread = Instance(WeatherCommsThread)
+    version = Int() # StatusPoller cycle of the last update
     
     def __init__(self):
-        log.info("Weather status thread initalized")
-        try:
-            self.telnet = telnetlib.Telnet(PELE, PELEPORT)
-        except Exception as e:
-            raise TCSConnectionError(e)
-        self.comms_thread = WeatherCommsThread()
-        self.comms_thread.resultobj = self
-
-
-class StatusCommsThread(GenericCommsThread):
-    abort = False
-    command = "?STATUS"
+        log.info("Weather status initalized")
 
 
 class Status(HasTraits):
@@ -450,29 +795,365 @@ class Status(HasTraits):
     HA_Axis_Soft_Limit_Status = String()
     Dec_Axis_Soft_Limit_Status = String()
     Horizon_Soft_Limit_Status = String()
-    comms_thread = Instance(StatusCommsThread)
+    version = Int() # StatusPoller cycle of the last update
     
     def __init__(self):
-        log.info("Status thread initalized")
+        log.info("Status initalized")
+
+
+class StatusPoller:
+    '''Polls ?POS, ?WEATHER and ?STATUS over a single TCS connection.
+
+    The three queries are written back to back each cycle and the replies
+    are fanned out to the Telescope, Weather and Status objects. Every
+    reply starts with a UTC= line, which marks the switch to the next one.
+    
+    A cycle is applied to the objects in one step under lock, with change
+    notification suppressed for the individual fields. Only values that
+    really changed are written: by more than their deadband for noisy
+    floats, at all for everything else. An object with changes besides
+    its clock fields then fires a single notification by setting its
+    version trait to the cycle number, and the subscribers are called
+    once with the changes of all objects. Readers that need a coherent
+    view of the three objects should hold lock while reading. Every
+    value polled, changed or not, is kept in a Telemetry.History per
+    object, and stamped with the time it was polled so that age() and
+    is_stale() can tell when the objects stop being refreshed.
+    
+    The time between polls adapts to what the telescope is doing:
+    fast_period while it is MOVING or a slow command is outstanding,
+    period at night, and backing off geometrically to idle_period while
+    the telescope idles in daylight. A slow command starting wakes the
+    poller immediately.
+    
+    The poller learns which keys a complete cycle returns. Once all of
+    them have arrived the cycle ends at once, rather than by waiting out
+    the line timeout. A cycle that ends in silence instead (the first
+    one, or after the TCS changes its key set) relearns the set. Lines
+    still unread when the next cycle starts are discarded, and mean the
+    set was incomplete, so it is relearned.
+    
+    The polling thread stops, with an error in the log, when the
+    connection fails. restart() polls again from a new thread on a new
+    connection; see Watchdog.'''
+    
+    abort = False
+    daemon = False
+    version = 0
+    recorder = None # Telemetry.Recorder that keeps every cycle on disk
+    fast_period = 0.5 # s between polls while the telescope moves
+    period = 2 # s between polls at night
+    idle_period = 30 # s, upper bound while idle in daylight
+    reply_timeout = 5 # s to wait for all replies of one cycle
+    line_timeout = .1 # s of silence that ends a cycle of unknown length
+    
+    # Smallest change worth publishing, by attribute
+    deadbands = {'Windspeed_Current': 0.5, 'Windspeed_Average': 0.5,
+        'Wind_Dir_Current': 10, 'Outside_Air_Temp': 0.1,
+        'Inside_Air_Temp': 0.1, 'Mirror_Temp': 0.1, 'Floor_Temp': 0.1,
+        'Bot_Tube_Temp': 0.1, 'Mid_Tube_Temp': 0.1, 'Top_Tube_Temp': 0.1,
+        'Top_Air_Temp': 0.1, 'Primary_Cell_Temp': 0.1,
+        'Secondary_Cell_Temp': 0.1, 'Outside_Rel_Hum': 1,
+        'Inside_Rel_Hum': 1, 'Outside_DewPt': 0.2, 'Inside_DewPt': 0.2,
+        'Lamp_Current': 0.01, 'Az': 0.01, 'El': 0.01, 'prlltc': 0.1,
+        'airmass': 0.005}
+    # Fields that change every cycle with the clock alone
+    clock_fields = set(['UTC', 'LST', 'JD', 'HA'])
+    
+    def __init__(self, telescope, weather, status, host=None, port=None):
+        if host is None: host = PELE
+        if port is None: port = PELEPORT
+        self.host = host
+        self.port = port
+        self.views = [("?POS", telescope, LineParser(POS_KEYS)),
+            ("?WEATHER", weather, LineParser(trait_keys(weather))),
+            ("?STATUS", status, LineParser(trait_keys(status)))]
+        self.lock = RLock()
+        self.updated = Condition(self.lock) # notified after every cycle
+        self.subscribers = []
+        self.idle_cycles = 0
+        self.current_period = self.period
+        self.polled = {} # record name -> time of its last poll
+        self.stamps = {} # record name -> {attribute: time of its last poll}
+        for cmd, obj, parser in self.views:
+            self.polled[obj.__class__.__name__] = 0
+            self.stamps[obj.__class__.__name__] = {}
+        
+        # Ring buffer history of the numeric fields, by record class name
+        self.history = {}
+        for cmd, obj, parser in self.views:
+            fields = [attr for attr, convert in parser.table.values()
+                if convert in (float, int)]
+            self.history[obj.__class__.__name__] = Telemetry.History(fields)
+        self.expected = set() # (section, key) of a complete cycle
+        self.n_framed = 0 # cycles ended by the expected key set
+        
+        self.thread = None
+        self.generation = 0 # bumped on every (re)start
+        self.started = 0 # time of the first start()
+        self.telnet = None # connected by the first start()
+    
+    def connect(self):
+        if self.telnet is not None:
+            # Also unblocks a thread stalled reading the old connection
+            try: self.telnet.close()
+            except: pass
         
         try:
-            self.telnet = telnetlib.Telnet(PELE, PELEPORT)
+            self.telnet = telnetlib.Telnet(self.host, self.port)
         except Exception as e:
             raise TCSConnectionError(e)
+    
+    def start(self):
+        '''Starts a polling thread, abandoning any previous one'''
+        if self.telnet is None: self.connect()
+        if self.started == 0: self.started = time.time()
+        self.generation += 1
+        self.thread = Thread(target=self.run, name="Status poller",
+            args=(self.generation, self.telnet))
+        self.thread.daemon = self.daemon
+        self.thread.start()
+    
+    def restart(self):
+        '''Polls again from a new thread on a new connection'''
+        log.info("Restarting the status poller")
+        self.connect()
+        self.start()
+    
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+    
+    def run(self, generation, telnet):
+        log.info("Starting the status poller")
+        try:
+            while not self.abort and generation == self.generation:
+                updates = self.poll(telnet)
+                self.apply(updates, generation)
+                self.current_period = self.next_period()
+                activity.wait(self.current_period)
+                activity.clear()
+        except Exception as e:
+            log.error("Status poller stopped: %s" % e)
+    
+    def poll(self, telnet):
+        '''Runs one cycle of queries and returns the parsed updates'''
+        
+        query = "".join(["%s\n" % cmd for cmd, obj, parser in self.views])
+        last = len(self.views) - 1
+        
+        try:
+            # Lines left over from a cycle that ended early would be read
+            # as the start of this one, and put it off by one section
+            stale = telnet.read_very_eager()
+            if stale != "":
+                log.debug("Status poller discarded '%s'" % stale.rstrip())
+                self.expected = set()
+            telnet.write(query)
+        except Exception as e:
+            raise TCSReadError(e)
+        
+        deadline = time.time() + self.reply_timeout
+        section = -1
+        updates = [{} for view in self.views]
+        seen = set()
+        partial = ""
+        while True:
+            r = telnet.read_until("\n", self.line_timeout)
+            if r == "":
+                # A gap between pipelined replies is not the end
+                if section == last:
+                    self.expected = seen
+                    break
+                if time.time() > deadline: break
+                continue
             
-        self.comms_thread = StatusCommsThread()
-        self.comms_thread.resultobj = self
+            if not r.endswith("\n"):
+                # Keep a line cut by the timeout for the next read
+                partial += r
+                if time.time() > deadline: break
+                continue
+            
+            r, partial = partial + r, ""
+            try:lhs,rhs = r.rstrip().split("=")
+            except: continue
+            
+            if lhs == 'UTC': section = min(section+1, last)
+            section = max(section, 0)
+            self.views[section][2].parse(updates[section], lhs, rhs)
+            
+            seen.add((section, lhs))
+            if section == last and len(seen) == len(self.expected) \
+                and seen == self.expected:
+                self.n_framed += 1
+                break
+        
+        return updates
     
+    def next_period(self):
+        '''Returns the s to wait before the next poll'''
         
+        telescope, status = self.views[0][1], self.views[2][1]
+        if telescope.Status == 'MOVING' or slow_command_outstanding():
+            self.idle_cycles = 0
+            return self.fast_period
+        
+        if status.Sunlight_Status == 'OKAY':
+            self.idle_cycles = 0
+            return self.period
+        
+        self.idle_cycles += 1
+        return min(self.period * 2**self.idle_cycles, self.idle_period)
+    
+    def apply(self, updates, generation=None):
+        '''Applies one cycle of parsed values as a single versioned update'''
+        
+        if not any(updates): return
+        
+        deltas = {}
+        t = time.time()
+        with self.lock:
+            # An abandoned thread that wakes up late must not write
+            if generation not in (None, self.generation): return
+            self.version += 1
+            for (cmd, obj, parser), values in zip(self.views, updates):
+                name = obj.__class__.__name__
+                if values: self.polled[name] = t
+                self.stamps[name].update(dict.fromkeys(values, t))
+                
+                delta = self.changes(obj, values)
+                obj.trait_set(trait_change_notify=False, **delta)
+                if set(delta) - self.clock_fields:
+                    obj.version = self.version
+                    deltas[name] = delta
+            self.updated.notify_all()
+        
+        for fun in self.subscribers:
+            if not deltas: break
+            try:
+                fun(self.version, deltas)
+            except Exception as e:
+                log.error("Status subscriber %s failed: %s" % (fun, e))
+        
+        for (cmd, obj, parser), values in zip(self.views, updates):
+            if not values: continue
+            name = obj.__class__.__name__
+            self.history[name].append(values, t)
+            if self.recorder is None: continue
+            try:
+                self.recorder.append(name, parser.table, values, t)
+            except Exception as e:
+                log.error("Telemetry recording failed, stopping it: %s" % e)
+                self.recorder = None
+    
+    def changes(self, obj, values):
+        '''Returns the values that differ from obj by more than their
+        deadband'''
+        
+        delta = {}
+        for field, value in values.items():
+            old = getattr(obj, field)
+            if field in self.deadbands:
+                if abs(value - old) > self.deadbands[field]:
+                    delta[field] = value
+            elif value != old:
+                delta[field] = value
+        return delta
+    
+    def subscribe(self, fun):
+        '''Calls fun(version, deltas) after every cycle with changes, where
+        deltas is {record class name: {attribute: new value}} and only
+        holds the records that changed'''
+        self.subscribers.append(fun)
+    
+    def wait(self, version, timeout=None):
+        '''Blocks until a cycle newer than version has been applied or
+        timeout s pass, and returns the current version'''
+        
+        with self.updated:
+            if self.version == version: self.updated.wait(timeout)
+            return self.version
+    
+    def age(self, name=None, field=None):
+        '''Returns the s since attribute field of record name, e.g.
+        "Weather", was last polled. Without field, since any of the
+        record was; without name, since the oldest of the three was.
+        Values never polled count from the first start().'''
+        
+        if name is None: t = min(self.polled.values())
+        elif field is None: t = self.polled[name]
+        else: t = self.stamps[name].get(field, 0)
+        return time.time() - max(t, self.started)
+    
+    def is_stale(self, name=None, field=None):
+        '''Returns true if the value has missed three polls'''
+        return self.age(name, field) > 3*self.current_period + \
+            self.reply_timeout
+        
+
+class Watchdog(Thread):
+    '''Restarts status pollers whose thread has died or whose records
+    have gone stale, e.g. after a network blip.
+
+    Failed restarts are retried with exponential backoff between
+    min_backoff and max_backoff s, and the backoff resets once a poller
+    is healthy again. restarts counts the restarts of each poller.'''
+    
+    abort = False
+    period = 5 # s between checks
+    min_backoff = 2
+    max_backoff = 300
+    
+    def __init__(self, pollers):
+        Thread.__init__(self, name="Status watchdog")
+        self.daemon = True
+        self.pollers = pollers
+        self.restarts = [0 for poller in pollers]
+        self.backoff = [self.min_backoff for poller in pollers]
+        self.next_try = [0 for poller in pollers]
+    
+    def run(self):
+        log.info("Starting the status watchdog")
+        while not self.abort:
+            for i in range(len(self.pollers)):
+                self.check(i)
+            time.sleep(self.period)
+    
+    def check(self, i):
+        poller = self.pollers[i]
+        if poller.abort: return
+        
+        if poller.is_alive() and not poller.is_stale():
+            self.backoff[i] = self.min_backoff
+            return
+        
+        now = time.time()
+        if now < self.next_try[i]: return
+        
+        log.warning("Status poller %s, last poll %i s ago. Restarting." %
+            ("stalled" if poller.is_alive() else "died", poller.age()))
+        self.next_try[i] = now + self.backoff[i]
+        self.backoff[i] = min(2*self.backoff[i], self.max_backoff)
+        try:
+            poller.restart()
+        except TCSConnectionError:
+            log.error("Could not restart status poller, retrying in %i s" %
+                (self.next_try[i] - now))
+            return
+        self.restarts[i] += 1
+
 
 class StatusThreads():
     '''
-    Maintains the status watching threads and provides convenience wrappers
-    around them.
+    Maintains the status poller and provides convenience wrappers
+    around it.
     '''
     telescope  = None
     weather = None
     status = None
+    poller = None
+    watchdog = None
+    lock = None
+    history = None
     started = False
     
     def __init__(self):
@@ -480,21 +1161,58 @@ class StatusThreads():
         self.telescope = Telescope()
         self.weather = Weather()
         self.status = Status()
+        self.poller = StatusPoller(self.telescope, self.weather, self.status)
+        self.watchdog = Watchdog([self.poller])
+        self.lock = self.poller.lock
+        self.history = self.poller.history
     
     def start(self):
         
         if not self.started:
             log.info("Starting threads")
-            self.telescope.comms_thread.start()
-            self.weather.comms_thread.start()
-            self.status.comms_thread.start()
+            self.poller.start()
+            if not self.watchdog.is_alive(): self.watchdog.start()
             self.started = True
     
     def stop(self):
         if self.started:
-            self.telescope.comms_thread.abort= True
-            self.weather.comms_thread.abort= True
-            self.status.comms_thread.abort= True
+            self.poller.abort = True
             self.started = False
         
-        self.telescope.UTC = self.weather.UTC = self.status.UTC = ''
+        with self.lock:
+            self.telescope.UTC = self.weather.UTC = self.status.UTC = ''
+    
+    def age(self, name=None, field=None):
+        return self.poller.age(name, field)
+    
+    def is_stale(self, name=None, field=None):
+        return self.poller.is_stale(name, field)
+    
+    def wait(self, version, timeout=None):
+        return self.poller.wait(version, timeout)
+    
+    def restarts(self):
+        '''Number of times the watchdog restarted the status poller'''
+        return self.watchdog.restarts[0]
+
+
+if __name__ == '__main__':
+    # Micro-benchmark of ?POS parsing
+    reply = ["%s=%s" % (key, '"M31"' if key == 'Object_Name' else
+        "12:34:56" if convert is str else "1.5")
+        for key, (attr, convert) in POS_KEYS.items()]
+    reply.append("Not_A_Key=1")
+    
+    parser = LineParser(POS_KEYS)
+    n_cycles = 20000
+    t0 = time.time()
+    for i in xrange(n_cycles):
+        updates = {}
+        for line in reply:
+            lhs, rhs = line.split("=")
+            parser.parse(updates, lhs, rhs)
+    dt = time.time() - t0
+    
+    print "Parsed %i lines in %2.3f s: %i lines/s" % (parser.n_lines, dt,
+        parser.n_lines/dt)
+    print "Unknown keys: %s" % parser.unknown
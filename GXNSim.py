@@ -0,0 +1,340 @@
+'''
+A stand-in for the P60 GXN interface, for exercising GXN and the FSM
+without the telescope.
+
+The simulator speaks enough of the protocol for GXN.Commands and
+GXN.StatusPoller: ?POS, ?WEATHER and ?STATUS replies, the fast commands
+and the slow commands with their result codes. Latency, move durations
+and faults are plain attributes of the Simulator and can be changed
+while it runs. To point the software at it:
+
+    GXN.PELE, GXN.PELEPORT = "127.0.0.1", 49300
+
+Run "python GXNSim.py [port]" to serve, or "python GXNSim.py bench" to
+measure the command and polling overheads through GXN.
+
+Released under GPLv2
+'''
+
+import logging as log
+import math
+import random
+import SocketServer
+import sys
+import time
+from threading import Event, Lock, Thread
+
+
+def sexagesimal(value, sign=False):
+    '''Formats value as [+-]dd:mm:ss.s'''
+    s = "-" if value < 0 else ("+" if sign else "")
+    tenths = int(round(abs(value) * 36000))
+    d, tenths = divmod(tenths, 36000)
+    m, tenths = divmod(tenths, 600)
+    return "%s%2.2i:%2.2i:%04.1f" % (s, d, m, tenths/10.)
+
+
+class SimTelescope:
+    '''State of the simulated telescope, shared by all connections'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.abort = Event()
+
+        self.ra = 0.0 # hours
+        self.dec = 33.36 # deg
+        self.target = (0.0, 33.36)
+        self.name = ""
+        self.motion = "TRACKING"
+        self.focus = 14.38 # mm
+        self.dome = "CLOSED"
+        self.lamp = "OFF"
+        self.ready = "READY"
+        self.control = "REMOTE"
+        self.windspeed = 3.0
+
+    def lst(self):
+        return (time.time() / 3600. * 1.0027379) % 24
+
+    def elevation(self):
+        '''Rough elevation for Palomar, good enough for airmass'''
+        ha = (self.lst() - self.ra) * 15 * math.pi/180
+        lat, dec = 33.356 * math.pi/180, self.dec * math.pi/180
+        s = math.sin(lat)*math.sin(dec) + \
+            math.cos(lat)*math.cos(dec)*math.cos(ha)
+        return math.asin(max(-1, min(1, s))) * 180/math.pi
+
+
+class Simulator(SocketServer.ThreadingTCPServer):
+    '''A GXN server on a local port. Each connection gets its own thread,
+    and a slow command blocks its connection until it completes, as on
+    the real TCS. A stop on any connection aborts a move in progress.'''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    latency = 0.0 # s before each reply
+    # s that each slow command takes
+    durations = {"pt": 2, "gopos": 20, "gofocus": 3, "open": 30,
+        "close": 30, "telinit": 60, "stow": 30, "lampon": 5}
+    faults = {} # command -> GXN result code returned instead of 0
+    silent = set() # commands that are never answered
+    drop_rate = 0.0 # chance that a request drops the connection
+
+    weather_status = "OKAY"
+    sunlight_status = "OKAY"
+    utsunset = "01:30"
+    utsunrise = "13:45"
+
+    def __init__(self, address=("127.0.0.1", 49300)):
+        SocketServer.ThreadingTCPServer.__init__(self, address, GXNHandler)
+        self.telescope = SimTelescope()
+        self.n_requests = {}
+
+    def start(self):
+        '''Serves from a background thread'''
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def execute(self, cmd, args):
+        '''Returns the reply to one request'''
+
+        T = self.telescope
+        self.n_requests[cmd] = self.n_requests.get(cmd, 0) + 1
+
+        if cmd == "?POS": return self.pos()
+        if cmd == "?WEATHER": return self.weather()
+        if cmd == "?STATUS": return self.status()
+        if cmd in self.faults: return "%i\n" % self.faults[cmd]
+
+        try: args = map(float, args)
+        except ValueError: return "-2\n"
+
+        if cmd == "takecontrol":
+            T.control = "REMOTE"
+        elif cmd == "stop":
+            T.abort.set()
+        elif cmd == "lampoff":
+            T.lamp = "OFF"
+        elif cmd == "coords":
+            if len(args) < 6: return "-2\n"
+            T.target = (args[0], args[1])
+        elif cmd == "pt":
+            if len(args) != 2: return "-2\n"
+            return self.move(cmd, lambda: self.offset(args[0], args[1]))
+        elif cmd == "gopos":
+            return self.move(cmd, self.slew)
+        elif cmd == "gofocus":
+            if len(args) != 1: return "-2\n"
+            return self.move(cmd, lambda: setattr(T, "focus", args[0]),
+                tracking=False)
+        elif cmd in ("open", "close"):
+            dome = {"open": "OPEN", "close": "CLOSED"}[cmd]
+            return self.move(cmd, lambda: setattr(T, "dome", dome),
+                tracking=False)
+        elif cmd == "telinit":
+            return self.move(cmd, lambda: setattr(T, "ready", "READY"))
+        elif cmd == "stow":
+            if len(args) != 3: return "-2\n"
+            T.target = ((T.lst() - args[0]) % 24, args[1])
+            return self.move(cmd, self.slew)
+        elif cmd == "lampon":
+            return self.move(cmd, lambda: setattr(T, "lamp", "ON"),
+                tracking=False)
+        else:
+            return "-1\n"
+
+        return "0\n"
+
+    def move(self, cmd, finish, tracking=True):
+        '''Blocks for the duration of cmd and returns its result code'''
+
+        T = self.telescope
+        T.abort.clear()
+        if tracking: T.motion = "MOVING"
+        aborted = T.abort.wait(self.durations.get(cmd, 0))
+        if tracking: T.motion = "TRACKING"
+
+        if aborted: return "-3\n"
+        with T.lock: finish()
+        return "0\n"
+
+    def offset(self, dRA, dDec):
+        T = self.telescope
+        T.ra += dRA / 3600. / 15
+        T.dec += dDec / 3600.
+
+    def slew(self):
+        T = self.telescope
+        T.ra, T.dec = T.target
+
+    def pos(self):
+        T = self.telescope
+        el = T.elevation()
+        airmass = 1/math.sin(max(el, 1) * math.pi/180)
+        ha = (T.lst() - T.ra + 12) % 24 - 12
+        return "".join(["%s=%s\n" % kv for kv in [
+            ("UTC", self.utc()),
+            ("LST", sexagesimal(T.lst())),
+            ("Julian_Date", "%f" % (time.time()/86400. + 2440587.5)),
+            ("Apparent_Equinox", "%f" % 2014.0),
+            ("Telescope_HA", sexagesimal(ha, True)),
+            ("Telescope_RA", sexagesimal(T.ra)),
+            ("Telescope_Dec", sexagesimal(T.dec, True)),
+            ("Telescope_RA_Rate", "0.000000"),
+            ("Telescope_Dec_Rate", "0.000000"),
+            ("Telescope_RA_Offset", "0.00"),
+            ("Telescope_Dec_Offset", "0.00"),
+            ("Telescope_Azimuth", "180.00"),
+            ("Telescope_Elevation", "%2.2f" % el),
+            ("Telescope_Parallactic", "0.00"),
+            ("Telescope_HA_Speed", "0.0000"),
+            ("Telescope_Dec_Speed", "0.0000"),
+            ("Telescope_HA_Refr(arcsec)", "0.00"),
+            ("Telescope_Dec_Refr(arcsec)", "0.00"),
+            ("Telescope_Motion_Status", T.motion),
+            ("Telescope_Airmass", "%2.3f" % airmass),
+            ("Object_Name", '"%s"' % T.name),
+            ("Telescope_Equinox", "2000.0"),
+            ("Object_RA", sexagesimal(T.target[0])),
+            ("Object_Dec", sexagesimal(T.target[1], True)),
+            ("Object_RA_Rate", "0.0"),
+            ("Object_DEC_Rate", "0.0"),
+            ("Object_RA_Proper_Motion", "0.0"),
+            ("Object_Dec_Proper_Motion", "0.0"),
+            ("Focus_Position", "%2.2f" % T.focus),
+            ("Dome_Gap(inch)", "0"),
+            ("Dome_Azimuth", "180.0"),
+            ("Windscreen_Elevation", "0"),
+            ("UTSunset", self.utsunset),
+            ("UTSunrise", self.utsunrise)]])
+
+    def weather(self):
+        T = self.telescope
+        T.windspeed = max(0, T.windspeed + random.gauss(0, 0.3))
+        return "".join(["%s=%s\n" % kv for kv in [
+            ("UTC", self.utc()),
+            ("Windspeed_Avg_Threshold", "25.0"),
+            ("Gust_Speed_Threshold", "40.0"),
+            ("Gust_Hold_Time", "900"),
+            ("Outside_DewPt_Threshold", "2.0"),
+            ("Inside_DewPt_Threshold", "2.0"),
+            ("Wetness_Threshold", "500"),
+            ("Wind_Dir_Current", "%2.1f" % random.uniform(0, 360)),
+            ("Windspeed_Current", "%2.1f" % T.windspeed),
+            ("Windspeed_Average", "%2.1f" % T.windspeed),
+            ("Outside_Air_Temp", "%2.1f" % random.gauss(8, 0.1)),
+            ("Outside_Rel_Hum", "30.0"),
+            ("Outside_DewPt", "-8.0"),
+            ("Inside_Air_Temp", "9.0"),
+            ("Inside_Rel_Hum", "28.0"),
+            ("Inside_DewPt", "-8.5"),
+            ("Mirror_Temp", "%2.2f" % random.gauss(8.5, 0.05)),
+            ("Floor_Temp", "9.0"),
+            ("Bot_Tube_Temp", "8.8"),
+            ("Mid_Tube_Temp", "8.7"),
+            ("Top_Tube_Temp", "8.6"),
+            ("Top_Air_Temp", "8.4"),
+            ("Primary_Cell_Temp", "8.9"),
+            ("Secondary_Cell_Temp", "8.6"),
+            ("Wetness", "0"),
+            ("Weather_Status", self.weather_status)]])
+
+    def status(self):
+        T = self.telescope
+        return "".join(["%s=%s\n" % kv for kv in [
+            ("UTC", self.utc()),
+            ("Telescope_ID", "60"),
+            ("Telescope_Control_Status", T.control),
+            ("Lamp_Status", T.lamp),
+            ("Lamp_Current", "0.00"),
+            ("Dome_Shutter_Status", T.dome),
+            ("WS_Motion_Mode", "AUTO"),
+            ("Dome_Motion_Mode", "AUTO"),
+            ("Telescope_Power_Status", "READY"),
+            ("Oil_Pad_Status", "READY"),
+            ("Weather_Status", self.weather_status),
+            ("Sunlight_Status", self.sunlight_status),
+            ("Remote_Close_Status", "NOT_OKAY"),
+            ("Telescope_Ready_Status", T.ready),
+            ("HA_Axis_Hard_Limit_Status", "OKAY"),
+            ("Dec_Axis_Hard_Limit_Status", "OKAY"),
+            ("Focus_Hard_Limit_Status", "OKAY"),
+            ("Focus_Soft_Up_Limit_Value", "20.00"),
+            ("Focus_Soft_Down_Limit_Value", "10.00"),
+            ("Focus_Soft_Limit_Status", "OKAY"),
+            ("Focus_Motion_Status", "STATIONARY"),
+            ("East_Soft_Limit_Value", "-6.0"),
+            ("West_Soft_Limit_Value", "6.0"),
+            ("North_Soft_Limit_Value", "90.0"),
+            ("South_Soft_Limit_Value", "-42.0"),
+            ("Horizon_Soft_Limit_Value", "10.0"),
+            ("HA_Axis_Soft_Limit_Status", "OKAY"),
+            ("Dec_Axis_Soft_Limit_Status", "OKAY"),
+            ("Horizon_Soft_Limit_Status", "OKAY")]])
+
+    def utc(self):
+        t = time.time()
+        return time.strftime("%Y:%j:%H:%M:", time.gmtime(t)) + \
+            "%04.1f" % (t % 60)
+
+
+class GXNHandler(SocketServer.StreamRequestHandler):
+    '''Serves one GXN connection'''
+
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        sim = self.server
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            words = line.split()
+            if len(words) == 0: continue
+
+            if random.random() < sim.drop_rate:
+                log.info("GXNSim dropping connection on '%s'" % line.rstrip())
+                return
+            if sim.latency > 0: time.sleep(sim.latency)
+            if words[0] in sim.silent: continue
+
+            self.wfile.write(sim.execute(words[0], words[1:]))
+
+
+def bench(n=200):
+    '''Times GXN commands and status polls against a local simulator'''
+    import GXN
+
+    sim = Simulator(("127.0.0.1", 0)).start()
+    sim.durations = {}
+    GXN.PELE, GXN.PELEPORT = sim.server_address
+
+    cmd = GXN.Commands(GXN.Session())
+    for name, fun in [("stop", cmd.stop), ("pt", lambda: cmd.pt(0, 0))]:
+        t0 = time.time()
+        for i in xrange(n): fun()
+        dt = (time.time() - t0) / n
+        print "%-6s %6.2f ms per command" % (name, dt*1000)
+
+    status = GXN.StatusThreads()
+    status.poller.period = status.poller.fast_period = 0
+    status.poller.daemon = True
+    t0 = time.time()
+    status.start()
+    while status.poller.version < n: time.sleep(0.01)
+    dt = (time.time() - t0) / status.poller.version
+    status.stop()
+    print "%-6s %6.2f ms per poll cycle (%i framed)" % ("poll", dt*1000,
+        status.poller.n_framed)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench()
+    else:
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else 49300
+        sim = Simulator(("127.0.0.1", port))
+        print "GXN simulator on %s:%i" % sim.server_address
+        sim.serve_forever()
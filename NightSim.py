@@ -0,0 +1,462 @@
+'''
+Replays a night of the state machine on a virtual clock, for measuring
+how scheduling and state logic changes affect a whole night.
+
+The FSM states run unchanged against stand-ins. GXNSim answers the GXN
+commands through the real Commands and CommandQueue, but every move
+takes its duration on the virtual clock, overlapping whatever the state
+machine does meanwhile. The status records are filled
+from GXNSim's replies every poll period of virtual time. Sun and
+weather follow either a synthetic night or a night recorded by
+Telemetry.Recorder. A simulated camera spends exposure plus readout
+on the virtual clock, and targets come from a synthetic queue. While
+the replay runs, time and datetime in FSM are replaced by the virtual
+clock, so waits and sleeps cost no real time.
+
+    import NightSim
+    print NightSim.NightReplay().run().report()
+
+Run "python NightSim.py [hours]" for a synthetic night.
+
+Released under GPLv2
+'''
+
+from datetime import datetime
+import numpy as np
+import random
+import sys
+from threading import Condition, current_thread, Lock
+import time
+
+import FSM
+import GXN
+import GXNSim
+import Pephem
+import SimpleQueue
+import Telemetry
+
+
+class VirtualClock:
+    '''Stands in for the time module. sleep() advances the clock at once
+    and then calls every listener.
+
+    Work that runs alongside the state machine, e.g. a telescope move on
+    the command queue worker, calls wait_until() with its end time
+    instead, so that it overlaps whatever the state machine does
+    meanwhile rather than adding to it. When no thread has moved the
+    clock for idle s of real time, e.g. the state machine waits on the
+    move, the clock jumps to the earliest end being waited for.'''
+
+    idle = 0.02 # s of real time
+
+    def __init__(self, t):
+        self.t = t
+        self.lock = Lock()
+        self.changed = Condition(self.lock)
+        self.waiting = [] # end times that threads wait for
+        self.n_waits = 0
+        self.listeners = []
+
+    def time(self):
+        return self.t
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.t += max(seconds, 0)
+            self.changed.notify_all()
+        for fun in self.listeners: fun()
+
+    def advance_to(self, t):
+        self.sleep(t - self.t)
+
+    def wait_until(self, t):
+        '''Blocks the calling thread until the clock reaches t'''
+        with self.lock:
+            self.waiting.append(t)
+            self.n_waits += 1
+            try:
+                while self.t < t:
+                    before = self.t
+                    self.changed.wait(self.idle)
+                    if self.t == before and t == min(self.waiting):
+                        self.t = t
+                        self.changed.notify_all()
+            finally:
+                self.waiting.remove(t)
+        for fun in self.listeners: fun()
+
+    def __getattr__(self, name):
+        # strftime, gmtime and friends
+        return getattr(time, name)
+
+def virtual_datetime(clock):
+    '''Returns a datetime class whose now() reads clock'''
+
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.fromtimestamp(clock.time(), tz)
+    return VirtualDatetime
+
+
+class ReplayTCS(GXNSim.Simulator):
+    '''GXNSim without the server. Moves wait out their duration on the
+    virtual clock, see VirtualClock.wait_until. Sunlight and weather status follow the clock, from recorded
+    telemetry if given and otherwise from the ephemeris and the
+    (start, end) times in outages.'''
+
+    def __init__(self, clock, recorded=None, outages=()):
+        self.telescope = GXNSim.SimTelescope()
+        self.n_requests = {}
+        self.clock = clock
+        self.recorded = recorded # record name -> loaded telemetry
+        self.outages = outages
+
+    def move(self, cmd, finish, tracking=True):
+        T = self.telescope
+        if tracking: T.motion = "MOVING"
+        self.clock.wait_until(self.clock.time() + self.durations.get(cmd, 0))
+        if tracking: T.motion = "TRACKING"
+        with T.lock: finish()
+        return "0\n"
+
+    def update(self):
+        t = self.clock.time()
+        if self.recorded is not None:
+            row = Telemetry.nearest(self.recorded['Status'], t)
+            self.weather_status = row['Weather_Status']
+            self.sunlight_status = row['Sunlight_Status']
+            if 'Telescope' in self.recorded:
+                row = Telemetry.nearest(self.recorded['Telescope'], t)
+                self.utsunset, self.utsunrise = row['UTSunset'], row['UTsnrs']
+            return
+
+        bad = any([t0 <= t < t1 for t0, t1 in self.outages])
+        self.weather_status = "NOT_OKAY" if bad else "OKAY"
+
+        night = Pephem.ephemeris(t)
+        self.sunlight_status = "NOT_OKAY" if night.is_sun_up(t) else "OKAY"
+        self.utsunset, self.utsunrise = [time.strftime("%H:%M",
+            time.gmtime(night.crossings[name]))
+            for name in ["sunset", "sunrise"]]
+
+    def pos(self):
+        self.update()
+        return GXNSim.Simulator.pos(self)
+
+    def status(self):
+        self.update()
+        return GXNSim.Simulator.status(self)
+
+
+class ReplayLink:
+    '''Stands in for the telnet connection of a GXN.Session. A request is
+    answered in full as it is written.'''
+
+    def __init__(self, tcs):
+        self.tcs = tcs
+        self.buffer = ""
+
+    def write(self, s):
+        words = s.split()
+        self.buffer += self.tcs.execute(words[0], words[1:])
+
+    def read_until(self, s, timeout=None):
+        i = self.buffer.find(s)
+        if i < 0: i = len(self.buffer)
+        else: i += len(s)
+        r, self.buffer = self.buffer[:i], self.buffer[i:]
+        return r
+
+    def expect(self, patterns, timeout=None):
+        return 0, None, self.read_until("\n").strip()
+
+    def read_very_eager(self):
+        r, self.buffer = self.buffer, ""
+        return r
+
+    def close(self):
+        pass
+
+class ReplayCommandQueue(GXN.CommandQueue):
+    '''CommandQueue that keeps its worker in step with the virtual clock.
+    submit() returns once the command has started waiting on the clock,
+    or has completed. Once the clock has passed the end of the command
+    in progress, whoever moved it waits for the command to complete.
+    Otherwise the state machine could run ahead of a worker thread that
+    has not been scheduled yet, and nothing would overlap.'''
+
+    def __init__(self, clock, session):
+        GXN.CommandQueue.__init__(self, session, session)
+        self.clock = clock
+        clock.listeners.append(self.settle)
+
+    def submit(self, name, *args, **kwargs):
+        n = self.clock.n_waits
+        pending = GXN.CommandQueue.submit(self, name, *args, **kwargs)
+        while not pending.done() and self.clock.n_waits == n:
+            time.sleep(0.001)
+        return pending
+
+    def settle(self):
+        if current_thread() is self: return
+        while self.current is not None and not self.abort and \
+            not [t for t in self.clock.waiting if t > self.clock.t]:
+            time.sleep(0.001)
+
+def replay_session(tcs):
+    session = GXN.Session()
+    session.T = ReplayLink(tcs)
+    return session
+
+
+class ReplayStatus(GXN.StatusThreads):
+    '''Status records polled from a ReplayTCS every period s of virtual
+    time, through the real StatusPoller parsing and versioning'''
+
+    period = 2
+
+    def __init__(self, clock, tcs):
+        GXN.StatusThreads.__init__(self)
+        self.clock = clock
+        self.tcs = tcs
+        self.next_poll = 0
+        self.poll_lock = Lock()
+        clock.listeners.append(self.catch_up)
+        self.catch_up()
+
+    def catch_up(self):
+        '''Polls once if a poll is due; missed polls are not made up'''
+        with self.poll_lock:
+            if self.clock.time() < self.next_poll: return
+            self.next_poll = self.clock.time() + self.period
+
+            updates = []
+            for cmd, obj, parser in self.poller.views:
+                values = {}
+                for line in self.tcs.execute(cmd, []).splitlines():
+                    try: lhs, rhs = line.split("=")
+                    except ValueError: continue
+                    parser.parse(values, lhs, rhs)
+                updates.append(values)
+        self.poller.apply(updates)
+
+    def start(self):
+        pass
+
+    def wait(self, version, timeout=None):
+        if self.poller.version == version:
+            t = self.next_poll
+            if timeout is not None: t = min(t, self.clock.time() + timeout)
+            self.clock.advance_to(t)
+        return self.poller.version
+
+
+class ReplayCamera:
+    '''Stands in for gui.Camera. An exposure takes its time plus readout
+    on the virtual clock.'''
+
+    readout_time = 30 # s
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.object = ""
+        self.shutter = "normal"
+        self.exposure = 0
+        self.filename = ""
+        self.pipelined = False
+        self.frames = [] # (object, shutter, exposure)
+
+    def run(self):
+        self.clock.sleep(self.exposure + self.readout_time)
+        self.frames.append((self.object, self.shutter, self.exposure))
+        self.filename = "replay_%4.4i.fits" % len(self.frames)
+
+    def burst(self, n, until=None):
+        filenames = []
+        for i in xrange(n):
+            if until is not None and until(): break
+            self.run()
+            filenames.append(self.filename)
+        return filenames
+
+    def wait_processed(self):
+        pass
+
+
+class ReplayFocus:
+    '''Stands in for Focus, always finding the nominal focus'''
+
+    def rc_focus_check(self, filenames):
+        return 14.38, [], []
+
+
+class ReplayQueue:
+    '''Stands in for SimpleQueue, with the same selection rule over a
+    fixed list of targets. Each target is handed out once.'''
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.selected = []
+
+    def select_next_target(self, lst):
+        h, m, s = map(float, lst.split(":"))
+        lstf = h*15 + m*15/60. + s*15/3600.
+
+        for i in xrange(len(self.targets)):
+            if i in self.selected: continue
+            if SimpleQueue.abs_diff(self.targets['ra'][i], lstf) < 60:
+                self.selected.append(i)
+                return self.targets[i:i+1]
+        return SimpleQueue.no_target
+
+    def modified(self):
+        return 0
+
+def synthetic_targets(n=200, seed=0):
+    '''Returns n targets spread over the sky, with ra in degrees and
+    exposure times in s by filter'''
+
+    rs = np.random.RandomState(seed)
+    targets = np.zeros(n, dtype=[('name', 'S16'), ('ra', 'f8'),
+        ('dec', 'f8'), ('epoch', 'f8'), ('u', 'f8'), ('g', 'f8'),
+        ('r', 'f8'), ('i', 'f8')])
+    targets['name'] = ["T%3.3i" % i for i in xrange(n)]
+    targets['ra'] = rs.uniform(0, 360, n)
+    targets['dec'] = rs.uniform(-20, 70, n)
+    targets['epoch'] = 2000
+    for fltr in "ugri": targets[fltr] = rs.choice([0, 60, 120, 180], n)
+    targets['r'] = np.maximum(targets['r'], 60)
+    return targets
+
+
+class NightReplay:
+    '''Runs FSM.StateMachine from start for hours of virtual time.
+
+    start defaults to 21:00 UT today, an hour or so before the afternoon
+    calibrations at Palomar. With recorded=(telemetry directory, night),
+    sun and weather come from that night's Status and Telescope records,
+    and start and hours default to the span of the recording. outages
+    are (hours after start, length in hours) of bad weather for a
+    synthetic night. The machine takes tick s of virtual time per state
+    execution, so that no state can spin without the clock moving.'''
+
+    tick = 0.1
+
+    def __init__(self, start=None, hours=17., targets=None, recorded=None,
+        outages=(), seed=0):
+
+        if recorded is not None:
+            directory, night = recorded
+            recorded = {}
+            for name in ['Status', 'Telescope']:
+                try:
+                    recorded[name] = Telemetry.load_night(directory, night,
+                        name)
+                except (IOError, OSError):
+                    if name == 'Status': raise
+            t = recorded['Status']['t']
+            if start is None:
+                start = t[0]
+                hours = (t[-1] - t[0]) / 3600.
+
+        if start is None:
+            start = (int(time.time()) // 86400) * 86400 + 21*3600
+        if targets is None: targets = synthetic_targets(seed=seed)
+
+        self.start = start
+        self.hours = hours
+        self.seed = seed
+        self.clock = VirtualClock(start)
+        self.tcs = ReplayTCS(self.clock, recorded,
+            [(start + t0*3600, start + (t0+dt)*3600) for t0, dt in outages])
+        self.camera = ReplayCamera(self.clock)
+        self.queue = ReplayQueue(targets)
+        self.profiler = FSM.StateProfiler()
+        self.stopped = "end of replay"
+        self.n_ticks = 0
+        self.real_seconds = 0
+
+    def run(self):
+        random.seed(self.seed)
+        session = replay_session(self.tcs)
+        commands = ReplayCommandQueue(self.clock, session)
+        commands.start()
+
+        installs = [(GXNSim, 'time', self.clock),
+            (GXN, 'the_queue', commands),
+            (FSM, 'time', self.clock),
+            (FSM, 'datetime', virtual_datetime(self.clock)),
+            (FSM, 'Status', ReplayStatus(self.clock, self.tcs)),
+            (FSM, 'rc_camera', self.camera),
+            (FSM, 'SimpleQueue', self.queue),
+            (FSM, 'Focus', ReplayFocus()),
+            (FSM, 'profiler', self.profiler),
+            (FSM, 'the_inputs', {'version': None}),
+            (FSM, 'next_target', []),
+            (FSM, 'closed_frames', {'night': None, 'bias': 0, 'dark': 0}),
+            (FSM, 'target_plan', []),
+            (FSM, 'last_focus', [datetime.fromtimestamp(self.start), 14.38]),
+            (FSM, 'force_focus', True),
+            (FSM, 'stop_loop', False)]
+        saved = [(module, name, getattr(module, name))
+            for module, name, value in installs]
+        for module, name, value in installs: setattr(module, name, value)
+
+        t0 = time.time()
+        try:
+            self.sm = FSM.StateMachine()
+            self.sm.statistics.flush_on_transition = False
+            self.sm.statistics.flush_interval = float("inf")
+            self.loop()
+        finally:
+            for module, name, value in saved: setattr(module, name, value)
+            commands.abort = True
+            self.real_seconds = time.time() - t0
+        return self
+
+    def loop(self):
+        end = self.start + self.hours*3600
+        while self.clock.time() < end:
+            inputs = FSM.get_input()
+            if not inputs['OK']:
+                self.clock.sleep(FSM.Status.period)
+                continue
+
+            if self.sm.next_state_name not in self.sm.statetable:
+                # Named by a state but not implemented, e.g. close
+                self.stopped = "no state '%s'" % self.sm.next_state_name
+                break
+
+            self.sm.execute(inputs)
+            self.n_ticks += 1
+            self.clock.sleep(self.tick)
+
+    def lost(self):
+        '''Returns {state: overhead + idle s}'''
+        return dict([(state, overhead + idle) for state, (shutter, overhead,
+            idle) in self.profiler.totals.items()])
+
+    def report(self):
+        science = [frame for frame in self.camera.frames if ":" in frame[0]]
+        shutter = sum([exposure for name, shutter, exposure in science])
+
+        lines = ["Replayed %2.1f h from %s UT in %2.1f s (%i ticks)" % (
+            self.hours, time.strftime("%Y-%m-%d %H:%M",
+            time.gmtime(self.start)), self.real_seconds, self.n_ticks),
+            "Stopped at %s UT: %s" % (time.strftime("%H:%M",
+            time.gmtime(self.clock.time())), self.stopped),
+            "Targets %i, science frames %i, science shutter open %2.2f h" %
+            (len(self.queue.selected), len(science), shutter/3600.),
+            "Shutter open %2.1f%%, overhead %2.1f%%, idle %2.1f%%" %
+            tuple(100*np.array(self.profiler.efficiency())),
+            "Time lost by state (overhead + idle):"]
+        lost = self.lost()
+        for state in sorted(lost, key=lambda s: -lost[s]):
+            lines.append("  %-34s %6.2f h" % (state, lost[state]/3600.))
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    hours = float(sys.argv[1]) if len(sys.argv) > 1 else 17.
+    print NightReplay(hours=hours).run().report()
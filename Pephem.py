@@ -10,23 +10,133 @@
 
 import ephem as Ep
 from datetime import datetime
+import numpy as np
+from threading import Lock
+import time
+
+import Telemetry
 
 Palomar = Ep.Observer()
 Palomar.lat  =   '33:21:21.6'
 Palomar.long = Ep.hours('-7:47:27')
 
+# ephem date of the unix epoch; ephem dates count days from 1899/12/31 12:00
+EPOCH = 25567.5
+
+def observer():
+    '''Returns a private copy of Palomar, safe to use from any thread'''
+    return Palomar.copy()
+
+def to_ephem(t):
+    return Ep.Date(t/86400. + EPOCH)
+
+def from_ephem(d):
+    return (float(d) - EPOCH) * 86400.
+
 def sun_now(time_now=None):
     ''' Return the sun's altitude relative to the local time on the clock '''
     
-    if time_now is not None:
-        Palomar.date = time_now
+    obs = observer()
+    if time_now is None: obs.date = Ep.now()
+    else: obs.date = time_now
         
     sun = Ep.Sun()
-    sun.compute(Palomar)
+    sun.compute(obs)
 
     return sun
 
 
+class NightEphemeris:
+    '''Sun and moon at Palomar for one night, from noon to noon Palomar
+    standard time, computed once on a grid of step s. Lookups at a time
+    t are an index into the grid, and the arrays are never changed after
+    construction, so one instance can be shared by every thread.
+    
+    crossings holds the unix times of sunset and sunrise (upper limb at
+    the horizon) and of the evening and morning 12 and 18 degree
+    twilights.'''
+    
+    step = 60 # s
+    sun_horizon = '-0:34'
+    
+    def __init__(self, night):
+        '''night as named by Telemetry.night_of, e.g. "2014_01_30"'''
+        
+        self.night = night
+        self.t0 = Telemetry.night_start(night)
+        self.t = self.t0 + np.arange(0, 86400 + self.step, self.step)
+        
+        obs = observer()
+        sun, moon = Ep.Sun(), Ep.Moon()
+        n = len(self.t)
+        self.sun_alt = np.empty(n)
+        self.moon_alt = np.empty(n)
+        self.moon_ra = np.empty(n)
+        self.moon_dec = np.empty(n)
+        for i, t in enumerate(self.t):
+            obs.date = to_ephem(t)
+            sun.compute(obs)
+            moon.compute(obs)
+            self.sun_alt[i] = sun.alt
+            self.moon_alt[i] = moon.alt
+            self.moon_ra[i] = moon.ra
+            self.moon_dec[i] = moon.dec
+        for a in [self.sun_alt, self.moon_alt, self.moon_ra, self.moon_dec]:
+            a *= 180/np.pi
+        
+        obs.date = to_ephem(self.t0)
+        self.moon_phase = Ep.Moon(obs).phase
+        
+        self.crossings = {}
+        for name, horizon, center in [("", self.sun_horizon, False),
+            ("12", '-12', True), ("18", '-18', True)]:
+            obs.horizon = horizon
+            obs.date = to_ephem(self.t0)
+            self.crossings["sunset" + name] = from_ephem(obs.next_setting(
+                sun, use_center=center))
+            self.crossings["sunrise" + name] = from_ephem(obs.next_rising(
+                sun, use_center=center))
+    
+    def index(self, t):
+        i = int(round((t - self.t0) / self.step))
+        return min(max(i, 0), len(self.t) - 1)
+    
+    def sun(self, t):
+        '''Sun altitude in degrees'''
+        return self.sun_alt[self.index(t)]
+    
+    def moon(self, t):
+        '''Moon (altitude, ra, dec) in degrees'''
+        i = self.index(t)
+        return self.moon_alt[i], self.moon_ra[i], self.moon_dec[i]
+    
+    def is_sun_up(self, t):
+        return not (self.crossings["sunset"] <= t <
+            self.crossings["sunrise"])
+    
+    def is_dark(self, t, degrees=12):
+        '''Returns true between the evening and morning twilights'''
+        return self.crossings["sunset%i" % degrees] <= t < \
+            self.crossings["sunrise%i" % degrees]
+
+
+the_nights = {}
+the_nights_lock = Lock()
+
+def ephemeris(t=None):
+    '''Returns the NightEphemeris of the night containing unix time t,
+    computing it on first use. Only the two latest nights are kept.'''
+    
+    if t is None: t = time.time()
+    night = Telemetry.night_of(t)
+    with the_nights_lock:
+        if night not in the_nights:
+            the_nights[night] = NightEphemeris(night)
+            for old in sorted(the_nights)[:-2]:
+                if old != night: del the_nights[old]
+        return the_nights[night]
+
+
 if __name__ == '__main__':
     s= sun_now()
     print s.alt 
@@ -34,3 +144,10 @@ if __name__ == '__main__':
     print s.alt
     s=sun_now(time_now='2014/01/28 14:39')
     print s.alt
+    
+    t = time.time()
+    e = ephemeris(t)
+    print "Sun %2.1f deg, computed in %2.2f s" % (e.sun(t), time.time() - t)
+    for name in sorted(e.crossings):
+        print "%-10s %s" % (name, time.strftime("%H:%M",
+            time.localtime(e.crossings[name])))
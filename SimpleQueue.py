@@ -5,6 +5,7 @@ import astropy
 from astropy.table import Table
 from astropy.coordinates import Angle
 import numpy as np
+import os
 
 TO_OBSERVE = "s://to_observe.txt"
 OBSERVED = "s://observed.txt"
@@ -22,6 +23,12 @@ def abs_diff(a, b):
     
     return np.abs(d)
 
+def modified():
+    '''Returns the modification time of the queue file, 0 if missing'''
+    
+    try: return os.path.getmtime(TO_OBSERVE)
+    except OSError: return 0
+
 def select_next_target(lst):
     
     h,m,s = map(float, lst.split(":"))
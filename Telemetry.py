@@ -0,0 +1,284 @@
+'''
+Telemetry history and nightly recording of the TCS status records.
+
+Released under GPLv2
+'''
+
+import calendar
+import json
+import logging as log
+import numpy as np
+import os
+from threading import Lock
+import time
+
+
+class History:
+    '''Fixed-memory history of the numeric fields of one status record.
+
+    Samples go into preallocated arrays used as a ring buffer, one row
+    per poll with its timestamp, so memory stays constant however long
+    the software runs. Fields missing from a poll are stored as NaN.
+    Queries select a time range with a vectorized mask and reduce it
+    with numpy.'''
+
+    def __init__(self, fields, length=10800):
+        '''length samples is 6 hours at the 2 s night poll rate'''
+        self.fields = list(fields)
+        self.columns = dict([(f, i) for i, f in enumerate(self.fields)])
+        self.length = length
+        self.t = np.zeros(length)
+        self.data = np.empty((length, len(self.fields)))
+        self.data.fill(np.nan)
+        self.n = 0 # samples ever appended
+        self.lock = Lock()
+
+    def append(self, values, t=None):
+        '''Stores the numeric values of a {field: value} dict at time t'''
+        if t is None: t = time.time()
+
+        with self.lock:
+            i = self.n % self.length
+            self.t[i] = t
+            row = self.data[i]
+            row.fill(np.nan)
+            for field, value in values.items():
+                if field in self.columns:
+                    row[self.columns[field]] = value
+            self.n += 1
+
+    def window(self, field, t0, t1=None):
+        '''Returns (times, values) of field between t0 and t1, in time
+        order. t0 < 0 means that many seconds before t1.'''
+        if t1 is None: t1 = time.time()
+        if t0 < 0: t0 = t1 + t0
+
+        with self.lock:
+            n = min(self.n, self.length)
+            t = self.t[:n]
+            keep = (t >= t0) & (t <= t1)
+            times = t[keep]
+            values = self.data[:n, self.columns[field]][keep]
+
+        order = np.argsort(times)
+        return times[order], values[order]
+
+    def mean(self, field, seconds, t1=None):
+        '''Mean of field over the last seconds, NaN if no samples'''
+        times, values = self.window(field, -seconds, t1)
+        values = values[np.isfinite(values)]
+        if len(values) == 0: return np.nan
+        return values.mean()
+
+    def max(self, field, seconds, t1=None):
+        times, values = self.window(field, -seconds, t1)
+        values = values[np.isfinite(values)]
+        if len(values) == 0: return np.nan
+        return values.max()
+
+    def trend(self, field, seconds, t1=None):
+        '''Least squares slope of field per second over the last seconds,
+        NaN with fewer than two samples'''
+        times, values = self.window(field, -seconds, t1)
+        ok = np.isfinite(values)
+        if ok.sum() < 2: return np.nan
+        return np.polyfit(times[ok] - times[ok][0], values[ok], 1)[0]
+
+
+class Recorder:
+    '''Appends every status poll to one fixed-schema binary file per
+    record per night, e.g. 2014_01_30_Weather.tel. A 1 kB text header
+    holds the numpy dtype, followed by packed records: t, then every
+    field, with strings truncated to 40 characters and missing floats
+    stored as NaN. Each record is flushed as it is written, so a crash
+    loses at most the poll in progress. Read files back with load().'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {} # record name -> (night, file, dtype, template)
+
+    def append(self, name, table, values, t=None):
+        '''Writes the {attribute: value} dict of record name, whose
+        attributes and converters are given by a LineParser table'''
+        if t is None: t = time.time()
+        night = night_of(t)
+
+        if name not in self.files or self.files[name][0] != night:
+            self.open(name, table, night)
+        night, f, dtype, template = self.files[name]
+
+        row = template.copy()
+        row['t'] = t
+        for field, value in values.items():
+            if field in dtype.names: row[field] = value
+        f.write(row.tobytes())
+        f.flush()
+
+    def open(self, name, table, night):
+        if name in self.files: self.files[name][1].close()
+
+        dtype = np.dtype([('t', 'f8')] + [(str(attr), column_type(convert))
+            for attr, convert in sorted(table.values())])
+        template = np.zeros(1, dtype=dtype)
+        for field in dtype.names:
+            if dtype[field].kind == 'f': template[field] = np.nan
+
+        fn = os.path.join(self.directory, "%s_%s.tel" % (night, name))
+        if os.path.exists(fn) and read_header(fn) != dtype:
+            # The schema changed during the night, e.g. a new TCS keyword
+            fn = fn[:-4] + "_%i.tel" % time.time()
+        
+        if os.path.exists(fn):
+            # Continue after the last whole record of a restarted night
+            n = (os.path.getsize(fn) - HEADER_SIZE) // dtype.itemsize
+            f = open(fn, "r+b")
+            f.seek(HEADER_SIZE + n*dtype.itemsize)
+            f.truncate()
+        else:
+            f = open(fn, "wb")
+            f.write(make_header(dtype))
+        self.files[name] = (night, f, dtype, template)
+
+    def close(self):
+        for night, f, dtype, template in self.files.values(): f.close()
+        self.files = {}
+
+
+HEADER_SIZE = 1024
+MAGIC = "RCTEL1 "
+
+def column_type(convert):
+    if convert is float: return 'f8'
+    if convert is int: return 'i4'
+    return 'S40'
+
+# Palomar standard time, fixed so that nights do not depend on the time
+# zone of the host or on daylight saving
+UTC_OFFSET = -8*3600 # s
+
+def night_of(t):
+    '''Name of the night containing time t; nights change at noon
+    Palomar standard time'''
+    return time.strftime("%Y_%m_%d", time.gmtime(t + UTC_OFFSET - 12*3600))
+
+def night_start(night):
+    '''Unix time of the noon that starts night, e.g. "2014_01_30"'''
+    return calendar.timegm(time.strptime(night + " 12", "%Y_%m_%d %H")) - \
+        UTC_OFFSET
+
+def make_header(dtype):
+    header = MAGIC + json.dumps(dtype.descr)
+    return header.ljust(HEADER_SIZE - 1) + "\n"
+
+def read_header(fn):
+    f = open(fn, "rb")
+    header = f.read(HEADER_SIZE)
+    f.close()
+    if not header.startswith(MAGIC):
+        raise IOError("%s is not a telemetry file" % fn)
+    descr = json.loads(header[len(MAGIC):].strip())
+    return np.dtype([(str(name), str(kind)) for name, kind in descr])
+
+def load(fn):
+    '''Memory-maps a Recorder file as a structured array. A record that
+    was cut short by a crash is ignored.'''
+    dtype = read_header(fn)
+    n = (os.path.getsize(fn) - HEADER_SIZE) // dtype.itemsize
+    if n == 0: return np.zeros(0, dtype=dtype)
+    return np.memmap(fn, dtype=dtype, mode='r', offset=HEADER_SIZE,
+        shape=(n,))
+
+def load_night(directory, night, name):
+    '''Returns the telemetry of record name, e.g. "Weather", for night,
+    e.g. "2014_01_30"'''
+    return load(os.path.join(directory, "%s_%s.tel" % (night, name)))
+
+def nearest(data, t):
+    '''Returns the row of loaded telemetry closest to time t'''
+    i = np.clip(np.searchsorted(data['t'], t), 1, len(data) - 1)
+    if abs(data['t'][i-1] - t) < abs(data['t'][i] - t): i -= 1
+    return data[i]
+
+
+class Latencies:
+    '''Histograms of command latencies, by command and kind of latency.
+
+    Bins are logarithmic from 1 ms to 1000 s. Alongside the counts the
+    exact number, sum and maximum are kept, so the summary gives exact
+    means and maxima and percentiles to within one bin (12% wide). When
+    the night changes the summary of the night that ended is written to
+    directory, if set, and the histograms start again.'''
+
+    edges = np.logspace(-3, 3, 121)
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self, t=None):
+        if t is None: t = time.time()
+        self.night = night_of(t)
+        self.counts = {} # (command, kind) -> counts per bin
+        self.n = {}
+        self.sum = {}
+        self.max = {}
+
+    def record(self, command, kind, dt, t=None):
+        '''Adds a latency of dt s, e.g. kind "wall" or "rtt"'''
+        if t is None: t = time.time()
+
+        ended = None
+        with self.lock:
+            if night_of(t) != self.night:
+                ended = Latencies(self.directory)
+                ended.night, ended.counts, ended.n, ended.sum, ended.max = \
+                    self.night, self.counts, self.n, self.sum, self.max
+                self.reset(t)
+
+            key = (command, kind)
+            if key not in self.counts:
+                self.counts[key] = np.zeros(len(self.edges) + 1, dtype=int)
+                self.n[key], self.sum[key], self.max[key] = 0, 0., 0.
+            self.counts[key][np.searchsorted(self.edges, dt)] += 1
+            self.n[key] += 1
+            self.sum[key] += dt
+            self.max[key] = max(self.max[key], dt)
+
+        # Written outside the lock, summary() takes it. A failure must
+        # not become the failure of the command being timed.
+        if ended is not None and self.directory is not None:
+            try:
+                ended.write(os.path.join(self.directory,
+                    "%s.txt" % ended.night))
+            except Exception as e:
+                log.error("Could not write latencies of %s: %s" %
+                    (ended.night, e))
+
+    def percentile(self, key, q):
+        '''Upper edge of the bin holding the q-th percentile, at most the
+        maximum'''
+        cumulative = np.cumsum(self.counts[key])
+        i = np.searchsorted(cumulative, q/100. * cumulative[-1])
+        return min(self.edges[min(i, len(self.edges) - 1)], self.max[key])
+
+    def summary(self):
+        '''Returns an astropy Table with one row per command and kind'''
+        from astropy.table import Table
+
+        rows = []
+        with self.lock:
+            for key in sorted(self.counts):
+                rows.append(key + (self.n[key], self.sum[key]/self.n[key],
+                    self.percentile(key, 50), self.percentile(key, 90),
+                    self.percentile(key, 99), self.max[key]))
+        names = ("Command", "Kind", "N", "Mean s", "P50 s", "P90 s",
+            "P99 s", "Max s")
+        dtype = ("S40", "S5", "i4", "f8", "f8", "f8", "f8", "f8")
+        if len(rows) == 0: return Table(names=names, dtype=dtype)
+        return Table(rows=rows, names=names, dtype=dtype)
+
+    def write(self, fn):
+        table = self.summary()
+        for name in table.colnames[3:]: table[name].format = "%.3f"
+        table.write(fn, format="ascii.fixed_width_two_line")
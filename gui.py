@@ -8,6 +8,7 @@ import numpy as np
 import logging as log
 import os
 import pyfits as pf
+import Queue
 import socket
 import subprocess
 from subprocess import check_output
@@ -113,162 +114,250 @@ class Camera(HasTraits):
     
     exposure = Float(10, desc="the exposure time in s",
         label = "Exposure")
+    
+    # If set, run() returns as soon as an image is read out and the header
+    # rewrite and display happen in the background; see wait_processed()
+    pipelined = False
+    processing = None # Queue of images waiting for processing
+        
+    def header_values(self):
+        '''Returns the (keyword, value) pairs of the status for the header'''
+        
+        hdrvalues_to_update = []
+        
+        stats = self.status_function()
+        header_vals = {}
+        
+        #flatten variables for header
+        for stat, stat_item in stats.items():
+            if type(stat_item) == dict:
+                for k,v in stat_item.items():
+                    header_vals[k] = v
+        
+        for k,v in header_vals.items():
+            if type(v) in [float, int, str]:
+                hdrvalues_to_update.append((k,v))
+        
+        return hdrvalues_to_update
+    
+    def settings(self):
+        return (self.name, self.object, self.target_name, self.amplifier,
+            self.readout, self.gain)
+    
+    def acquire(self):
+        '''Takes one frame and returns its raw file name. The caller sets
+        the socket timeout.'''
         
+        number_acq_attempts = 2
+        while number_acq_attempts > 0:
+            try:
+                filename = self.connection.acquire().data
+                number_acq_attempts = 0
+            except Exception as e:
+                log.info("Received exception %s" % e)
+                self.make_connection()
+                    
+                number_acq_attempts -= 1
+                filename = ''
+        
+        if filename == '':
+            raise ExposureCommsProblem("Could not read camera, server keeps failing. Likely a hardware issue")
+        
+        if not os.path.exists(filename):
+            raise ExposureCommsProblem("Camera timed out. Likely a reconnect or reboot is needed.")
+        
+        self.filename = filename
+        return filename
+    
     def run(self):
         nexp = self.num_exposures
         while self.num_exposures > 0:
             
-            hdrvalues_to_update = []
-            
-            stats = self.status_function()
-            header_vals = {}
-            
-            #flatten variables for header
-            for stat, stat_item in stats.items():
-                if type(stat_item) == dict:
-                    for k,v in stat_item.items():
-                        header_vals[k] = v
-            
-            for k,v in header_vals.items():
-                if type(v) in [float, int, str]:
-                    hdrvalues_to_update.append((k,v))
-
+            hdrvalues_to_update = self.header_values()
 
             socket.setdefaulttimeout(self.exposure + 60)
-            number_acq_attempts = 2
-            while number_acq_attempts > 0:
-                try:
-                    filename = self.connection.acquire().data
-                    number_acq_attempts = 0
-                except Exception as e:
-                    log.info("Received exception %s" % e)
-                    self.make_connection()
-                        
-                    number_acq_attempts -= 1
-                    filename = ''
-                    
-            socket.setdefaulttimeout(None)
-            
-            if filename == '':
-                raise ExposureCommsProblem("Could not read camera, server keeps failing. Likely a hardware issue")
-            
-            if not os.path.exists(filename):
-                raise ExposureCommsProblem("Camera timed out. Likely a reconnect or reboot is needed.")
-                
-            self.filename = filename
-            self.state = "Updating Fits %s" % filename
             try:
-                hdus = pf.open(filename)
-                hdr = hdus[0].header
-                hdr.update("OBJECT",self.object)
-            except:
-                self.state = "Could not open raw fits"
+                filename = self.acquire()
+            finally:
+                socket.setdefaulttimeout(None)
+                
+            settings = self.settings()
+            if self.pipelined:
+                self.start_processing()
+                self.processing.put((filename, hdrvalues_to_update, settings))
+            elif not self.process(filename, hdrvalues_to_update, settings):
                 return
             
+            self.num_exposures -= 1
+        self.num_exposures = 1
+        self.state = "Idle"
+        if nexp > 1: play_sound("SystemExclamation")
+    
+    def burst(self, n, until=None):
+        '''Takes n frames back to back with the current settings and
+        returns their file names. The settings are read, and the socket
+        timeout set, once for the whole burst. Each frame gets its own
+        status snapshot, is only acquired, and has its header written in
+        the background as with pipelined. With until, stops before the
+        next frame once until() is true.'''
+        
+        settings = self.settings()
+        self.start_processing()
+        
+        filenames = []
+        socket.setdefaulttimeout(self.exposure + 60)
+        try:
+            for i in xrange(n):
+                if until is not None and until(): break
+                self.state = "Burst %i/%i" % (i+1, n)
+                hdrvalues_to_update = self.header_values()
+                filename = self.acquire()
+                filenames.append(filename)
+                self.processing.put((filename, hdrvalues_to_update +
+                    [("BURSTNUM", i+1), ("BURSTLEN", n)], settings))
+        finally:
+            socket.setdefaulttimeout(None)
+            self.state = "Idle"
+        
+        return filenames
+    
+    def process(self, filename, hdrvalues_to_update, settings):
+        '''Writes the header of a new image and displays it. Returns False
+        if the image could not be rewritten.'''
+        
+        name, object, target_name, amplifier, readout, gain_index = settings
+        self.state = "Updating Fits %s" % filename
+        try:
+            hdus = pf.open(filename)
+            hdr = hdus[0].header
+            hdr.update("OBJECT",object)
+        except:
+            self.state = "Could not open raw fits"
+            return False
+        
 
-            for el in hdrvalues_to_update:
-                trait, val = el
+        for el in hdrvalues_to_update:
+            trait, val = el
 
-                try: hdr.update(trait, val)
-                except: pass
-            
-            if self.name == 'ifu':
-                if self.amplifier == 1:
-                    if self.readout == 0.1:
-                        if self.gain == 1: gain = 3.29
-                        if self.gain == 2: gain = 1.78
-                        if self.gain == 3: gain = 0.89
-                    if self.readout == 2:
-                        if self.gain == 1: gain = 3.49
-                        if self.gain == 2: gain = 1.82
-                        if self.gain == 3: gain = 0.90
-                if self.amplifier == 2:
-                    if self.readout == 0.1:
-                        if self.gain == 1: gain = 14.72
-                        if self.gain == 2: gain = 7.03
-                        if self.gain == 3: gain = 3.49
-                    if self.readout == 2:
-                        if self.gain == 1: gain = 13.92
-                        if self.gain == 2: gain = 6.88
-                        if self.gain == 3: gain = 3.43
-            elif self.name == 'rc':
-                if self.amplifier == 1:
-                    if self.readout == 0.1:
-                        if self.gain == 1: gain = 3.56
-                        if self.gain == 2: gain = 1.77
-                        if self.gain == 3: gain = 0.90
-                    if self.readout == 2:
-                        if self.gain == 1: gain = 3.53
-                        if self.gain == 2: gain = 1.78
-                        if self.gain == 3: gain = 0.88
-                if self.amplifier == 2:
-                    if self.readout == 0.1:
-                        if self.gain == 1: gain = 14.15
-                        if self.gain == 2: gain = 7.27
-                        if self.gain == 3: gain = 3.79
-                    if self.readout == 2:
-                        if self.gain == 1: gain = 14.09
-                        if self.gain == 2: gain = 7.02
-                        if self.gain == 3: gain = 3.52
-                        
-            hdr.update("GAIN", gain, 'gain in e-/ADU')
-            hdr.update("CHANNEL", self.name, "Instrument channel")
-            hdr.update("TNAME", self.target_name, "Target name")
-            
-            if self.name == 'rc':
-                hdr.update("CRPIX1", 1293, "Center pixel position")
-                hdr.update("CRPIX2", 1280, "")
-                hdr.update("CDELT1", -0.00010944, "0.394 as")
-                hdr.update("CDELT2" ,-0.00010944, "0.394 as")
-                hdr.update("CTYPE1", "RA---TAN")
-                hdr.update("CTYPE2", "DEC--TAN")
-                hdr.update("CRVAL1", ra_to_deg(hdr["RA"]), "from tcs")
-                hdr.update("CRVAL2", dec_to_deg(hdr["Dec"]), "from tcs")
-            elif self.name == 'ifu':
-                hdr.update("CRPIX1", 1075, "Center pixel position")
-                hdr.update("CRPIX2", 974, "Center pixel position")
-                hdr.update("CDELT1", -0.0000025767, "0.00093 as")
-                hdr.update("CDELT2", -0.0000025767, "0.00093 as")
-                hdr.update("CTYPE1", "RA---TAN")
-                hdr.update("CTYPE2", "DEC--TAN")
-                as120 = 0.03333
-                hdr.update("CRVAL1", ra_to_deg(hdr["ra"]) - as120, "from tcs")
-                hdr.update("CRVAL2", dec_to_deg(hdr["dec"]) - as120, "from tcs")
+            try: hdr.update(trait, val)
+            except: pass
+        
+        if name == 'ifu':
+            if amplifier == 1:
+                if readout == 0.1:
+                    if gain_index == 1: gain = 3.29
+                    if gain_index == 2: gain = 1.78
+                    if gain_index == 3: gain = 0.89
+                if readout == 2:
+                    if gain_index == 1: gain = 3.49
+                    if gain_index == 2: gain = 1.82
+                    if gain_index == 3: gain = 0.90
+            if amplifier == 2:
+                if readout == 0.1:
+                    if gain_index == 1: gain = 14.72
+                    if gain_index == 2: gain = 7.03
+                    if gain_index == 3: gain = 3.49
+                if readout == 2:
+                    if gain_index == 1: gain = 13.92
+                    if gain_index == 2: gain = 6.88
+                    if gain_index == 3: gain = 3.43
+        elif name == 'rc':
+            if amplifier == 1:
+                if readout == 0.1:
+                    if gain_index == 1: gain = 3.56
+                    if gain_index == 2: gain = 1.77
+                    if gain_index == 3: gain = 0.90
+                if readout == 2:
+                    if gain_index == 1: gain = 3.53
+                    if gain_index == 2: gain = 1.78
+                    if gain_index == 3: gain = 0.88
+            if amplifier == 2:
+                if readout == 0.1:
+                    if gain_index == 1: gain = 14.15
+                    if gain_index == 2: gain = 7.27
+                    if gain_index == 3: gain = 3.79
+                if readout == 2:
+                    if gain_index == 1: gain = 14.09
+                    if gain_index == 2: gain = 7.02
+                    if gain_index == 3: gain = 3.52
+                    
+        hdr.update("GAIN", gain, 'gain in e-/ADU')
+        hdr.update("CHANNEL", name, "Instrument channel")
+        hdr.update("TNAME", target_name, "Target name")
+        
+        if name == 'rc':
+            hdr.update("CRPIX1", 1293, "Center pixel position")
+            hdr.update("CRPIX2", 1280, "")
+            hdr.update("CDELT1", -0.00010944, "0.394 as")
+            hdr.update("CDELT2" ,-0.00010944, "0.394 as")
+            hdr.update("CTYPE1", "RA---TAN")
+            hdr.update("CTYPE2", "DEC--TAN")
+            hdr.update("CRVAL1", ra_to_deg(hdr["RA"]), "from tcs")
+            hdr.update("CRVAL2", dec_to_deg(hdr["Dec"]), "from tcs")
+        elif name == 'ifu':
+            hdr.update("CRPIX1", 1075, "Center pixel position")
+            hdr.update("CRPIX2", 974, "Center pixel position")
+            hdr.update("CDELT1", -0.0000025767, "0.00093 as")
+            hdr.update("CDELT2", -0.0000025767, "0.00093 as")
+            hdr.update("CTYPE1", "RA---TAN")
+            hdr.update("CTYPE2", "DEC--TAN")
+            as120 = 0.03333
+            hdr.update("CRVAL1", ra_to_deg(hdr["ra"]) - as120, "from tcs")
+            hdr.update("CRVAL2", dec_to_deg(hdr["dec"]) - as120, "from tcs")
 
-            new_hdu = pf.PrimaryHDU(np.uint16(hdus[0].data), header=hdr)
-            hdus.close()
+        new_hdu = pf.PrimaryHDU(np.uint16(hdus[0].data), header=hdr)
+        hdus.close()
 
-            tempname = "c:/users/sedm/appdata/local/temp/sedm_temp.fits"
-            origname = filename
+        tempname = "c:/users/sedm/appdata/local/temp/sedm_temp.fits"
+        origname = filename
 
+        
+        try: os.remove(tempname)
+        except WindowsError: pass
+        
+        try:
+            os.rename(origname, tempname)
+        except Exception as e:
+            log.error("Rename %s to %s failed" % (filename, tempname))
+            self.state = "Rename %s to %s failed" % (filename, tempname)
+            play_sound("SystemExclamation")
+            return False
+        
+        try:
+            new_hdu.writeto(filename)
+        except:
+            os.rename(tempname, filename)
+            self.state = "Could not write extension [2]"
+            play_sound("SystemExclamation")
+            return False
             
-            try: os.remove(tempname)
-            except WindowsError: pass
-            
+
+        play_sound("SystemAsterix")    
+        
+        ds9_image(self.xpa_class,  filename)
+        return True
+    
+    def start_processing(self):
+        if self.processing is not None: return
+        
+        self.processing = Queue.Queue()
+        worker = Thread(target=self.process_queue)
+        worker.daemon = True
+        worker.start()
+    
+    def process_queue(self):
+        '''Processes images one at a time, in the order they were taken'''
+        while True:
+            filename, hdrvalues_to_update, settings = self.processing.get()
             try:
-                os.rename(origname, tempname)
+                self.process(filename, hdrvalues_to_update, settings)
             except Exception as e:
-                log.error("Rename %s to %s failed" % (filename, tempname))
-                self.state = "Rename %s to %s failed" % (filename, tempname)
-                play_sound("SystemExclamation")
-                return
-            
-            try:
-                new_hdu.writeto(filename)
-            except:
-                os.rename(tempname, filename)
-                self.state = "Could not write extension [2]"
-                play_sound("SystemExclamation")
-                return
-                
-
-            play_sound("SystemAsterix")    
-            
-            ds9_image(self.xpa_class,  filename)
-            self.num_exposures -= 1
-        self.num_exposures = 1
-        self.state = "Idle"
-        if nexp > 1: play_sound("SystemExclamation")
+                log.error("Could not process %s: %s" % (filename, e))
+            self.processing.task_done()
+    
+    def wait_processed(self):
+        '''Blocks until every image taken so far is written and displayed'''
+        if self.processing is not None: self.processing.join()
 
     def make_connection(self):
         sedmpy = "C:/Users/sedm/Dropbox/Python-3.3.0/PCbuild/amd64/python.exe"